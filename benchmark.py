@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from workflow import (TRACK_DTYPE, TRACK_FIELDS, TRACK_PAYLOAD_BYTES, TRACK_RECORD_DTYPE, build_polylines,
+                      chain_files, decimate_files, decode_tracks, rasterize_tracks, stage_timer, track_files)
+
+# Share of the records written to the em, mu and hd track files
+PARTICLE_SHARES = (0.9, 0.02, 0.08)
+PARTICLE_CODES = ((1., 2., 3.), (5., 6.), (8., 9., 13., 14.))
+
+def synthetic_tracks(count, mean_length=20, branching=0.3, seed=1, particles=(1., 2., 3.), vertical_share=0.05):
+    """Generates a shower-like set of chained and branching track segments.
+
+    A vertical_share of the segments do not move in x, like the degenerate
+    segments the decoder filters out.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.geometric(1 / mean_length, size=count // mean_length * 2 + 1)
+    lengths = lengths[:np.searchsorted(np.cumsum(lengths), count) + 1]
+    lengths[-1] -= lengths.sum() - count
+    lengths = lengths[lengths > 0]
+    chains = len(lengths)
+    chain_of_segment = np.repeat(np.arange(chains), lengths)
+    first_segment = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    steps = rng.normal(scale=100., size=(count, 3)).astype('f4')
+    steps[:, 2] = -np.abs(steps[:, 2]) - 1.
+    steps[rng.random(count) < vertical_share, 0] = 0.
+    dt = rng.exponential(1e-6, size=count).astype('f4')
+
+    # Walk positions and times along each chain from a per-chain origin
+    walk = np.cumsum(steps, axis=0)
+    walk -= (walk - steps)[first_segment][chain_of_segment]
+    clock = np.cumsum(dt)
+    clock -= (clock - dt)[first_segment][chain_of_segment]
+    origin = np.zeros((chains, 3), dtype='f4')
+    origin[:, 2] = 1e6
+    start_time = np.zeros(chains, dtype='f4')
+    # Secondary chains branch off the end of a segment of an earlier chain
+    branches = np.flatnonzero(rng.random(chains) < branching)
+    branches = branches[branches > 0]
+    for chain in branches.tolist():
+        parent = first_segment[rng.integers(chain)]
+        parent += rng.integers(lengths[chain_of_segment[parent]])
+        origin[chain] = origin[chain_of_segment[parent]] + walk[parent]
+        start_time[chain] = start_time[chain_of_segment[parent]] + clock[parent]
+
+    end = origin[chain_of_segment] + walk
+    tend = start_time[chain_of_segment] + clock
+    # Each segment starts exactly where the previous one of its chain ended
+    start = np.roll(end, 1, axis=0)
+    start[first_segment] = origin
+    tstart = np.roll(tend, 1)
+    tstart[first_segment] = start_time
+    tracks = np.empty(count, dtype=TRACK_DTYPE)
+    tracks['particle'] = rng.choice(particles, size=count)
+    tracks['energy'] = rng.pareto(1.7, size=count) + 1e-3
+    for column, axis in enumerate(['x', 'y', 'z']):
+        tracks[axis] = start[:, column]
+        tracks[axis + 'end'] = end[:, column]
+    tracks['t'] = tstart
+    tracks['tend'] = tend
+    return tracks
+
+def write_track_files(runnr, records, directory='.', seed=1, chunk_records=1 << 20):
+    """Writes synthetic DATnnnnnn.track_em/_mu/_hd files holding about records track records in total."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for (datafile, _), share, particles in zip(track_files(runnr), PARTICLE_SHARES, PARTICLE_CODES):
+        path = os.path.join(directory, datafile)
+        remaining = max(1, int(records * share))
+        with open(path, 'wb') as file:
+            while remaining:
+                count = min(remaining, chunk_records)
+                tracks = synthetic_tracks(count, seed=int(rng.integers(2**31)), particles=particles)
+                chunk = np.empty(count, dtype=TRACK_RECORD_DTYPE)
+                chunk['head'] = chunk['tail'] = TRACK_PAYLOAD_BYTES
+                for name in TRACK_FIELDS:
+                    chunk[name] = tracks[name]
+                chunk.tofile(file)
+                remaining -= count
+        paths.append(path)
+    return paths
+
+def chain_decoded(runnr):
+    """Chains the full decoded files, so chaining is measured at every size rather than on the sample."""
+    for file_name in sorted(glob.glob("EDresults_*.npy")):
+        build_polylines(np.load(file_name, mmap_mode='r'))
+
+def input_records(patterns):
+    """Counts the track records or decoded segments held by the files matching patterns."""
+    records = 0
+    for path in sorted({path for pattern in patterns for path in glob.glob(pattern)}):
+        if path.endswith('.npy'):
+            records += len(np.load(path, mmap_mode='r'))
+        else:
+            records += os.path.getsize(path) // TRACK_RECORD_DTYPE.itemsize
+    return records
+
+# Stage -> (action, files it reads, files it writes)
+# chain only sees the decimated sample and rasterize draws a 500 pixel wide image; polylines chains everything
+BENCHMARK_STAGES = {
+    'decode': (lambda runnr: decode_tracks(runnr), ["DAT*.track_*"], ["EDresults_*.npy"]),
+    'decimate': (lambda runnr: decimate_files(['EDresults_em.npy', 'EDresults_mu.npy', 'EDresults_hd.npy'],
+                                              [100000, 0, 0], 'stratified'),
+                 ["EDresults_*.npy"], ["EDsample_*.npy"]),
+    'chain': (lambda runnr: chain_files(['EDsample_em.npy', 'EDsample_mu.npy', 'EDsample_hd.npy']),
+              ["EDsample_*.npy"], ["polylines_*.npz"]),
+    'polylines': (chain_decoded, ["EDresults_*.npy"], []),
+    'rasterize': (lambda runnr: rasterize_tracks(runnr, width=500), ["DAT*.track_*"], ["track*.png"])
+}
+
+def benchmark_stages(sizes, stages=tuple(BENCHMARK_STAGES), directory=None, runnr=1):
+    """Times and memory-profiles the post-processing stages on synthetic track files of each size."""
+    results = []
+    print(f"{'stage':<10} {'records':>12} {'read':>12} {'seconds':>9} {'read/s':>12} {'cpu s':>8} {'peak rss MB':>12}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory(dir=directory) as workdir:
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                write_track_files(runnr, size)
+                for stage in BENCHMARK_STAGES:
+                    if stage not in stages:
+                        continue
+                    report = {'path': os.devnull, 'stages': []}
+                    # Every stage prints its own progress; keep the table readable
+                    action, inputs, outputs = BENCHMARK_STAGES[stage]
+                    read = input_records(inputs)
+                    with stage_timer(report, stage, inputs, outputs) as record, contextlib.redirect_stdout(io.StringIO()):
+                        action(runnr)
+                    # Without a per-stage peak (not Linux) only the lifetime peak from getrusage is known
+                    record['stage_peak_rss_kb'] = record['peak_rss_kb'] or record['workflow_peak_rss_kb']
+                    record['records'] = size
+                    record['records_read'] = read
+                    results.append(record)
+                    cpu = record['cpu_user_s'] + record['cpu_system_s']
+                    print(f"{stage:<10} {size:>12} {read:>12} {record['wall_s']:>9.2f} {read / record['wall_s']:>12.0f} {cpu:>8.2f} "
+                          f"{record['stage_peak_rss_kb'] / 1024:>12.1f}")
+            finally:
+                os.chdir(cwd)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the track post-processing stages on synthetic showers.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5, 10**6],
+                        help="numbers of track records to generate (10^4 to 10^8)")
+    parser.add_argument('--stages', nargs='+', choices=list(BENCHMARK_STAGES), default=list(BENCHMARK_STAGES),
+                        help="stages to benchmark")
+    parser.add_argument('--workdir', help="directory for the temporary track files [DEFAULT: system temp dir]")
+    parser.add_argument('--json', metavar='FILE', help="also write the measurements to a JSON file")
+    parser.add_argument('--generate', type=int, metavar='RECORDS',
+                        help="only write synthetic DAT000001.track_* files of this size to the current directory")
+    args = parser.parse_args()
+
+    if args.generate:
+        for path in write_track_files(1, args.generate):
+            print(f"  Generated: {path}")
+        return
+    results = benchmark_stages(args.sizes, args.stages, args.workdir)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -2,37 +2,55 @@ import sys
 import subprocess
 import os
 import shutil
+import io
+import struct
+import json
+import argparse
+import itertools
+import concurrent.futures
+import hashlib
+import glob
+import time
+import zlib
+import contextlib
+import resource
+import platform
+import re
+import collections
+import threading
+import functools
+import stat
+import sqlite3
 
-def generate_input_file():
-    """Generates the input file for CORSIKA simulation."""
-    print("\nPlease fill in the following fields (use TAB to separate multiple options):\n")
-    
-    # Collect user parameters
-    RUNNR = input("run number [DEFAULT: 1]: ") or "1"
-    NSHOW = input("number of showers to generate [DEFAULT: 1]: ") or "1"
-    PRMPAR = input("prim. particle (1=gamma, 14=proton, 5626=iron, ...) [DEFAULT: 14]: ") or "14"
-    ESLOPE = input("slope of primary energy spectrum [DEFAULT: -2.7]: ") or "-2.7"
-    ERANGE = input("energy range of primary particle (GeV) [DEFAULT: 1.E3   1.E3]: ") or "1.E3  1.E3"
-    THETAP = input("range of zenith angle (degree) [DEFAULT: 0. 0.]: ") or "0.  0."
-    PHIP = input("range of azimuth angle (degree) [DEFAULT: -180.   180.]: ") or "-180. 180."
-    SEED1 = input("seed for 1. random number sequence [DEFAULT: 1   0   0]: ") or "1    0   0"
-    SEED2 = input("seed for 2. random number sequence [DEFAULT: 2   0   0]: ") or "2    0   0"
-    OBSLEV = input("observation level (in cm) [DEFAULT: 0.]: ") or "0."
-    MAGNET = input("magnetic field centr. Europe [DEFAULT: 20.0 42.8]: ") or "20.0  42.8"
-    HADFLG = input("flags hadr.interact.&fragmentation [DEFAULT: 0  0   0   0   0   2]: ") or "0    0   0   0   0   2"
-    ECUTS = input("energy cuts for particles [DEFAULT: 1.   1.  0.001   0.001]: ") or "1.   1.  0.001   0.001"
-    MUADDI = input("additional info for muons (T/F) [DEFAULT: T]: ") or "T"
-    MUMULT = input("muon multiple scattering angle (T/F) [DEFAULT: T]: ") or "T"
-    ELMFLG = input("em. interaction flags (NKG,EGS) [DEFAULT: T T]: ") or "T    T"
-    STEPFC = input("mult. scattering step length fact [DEFAULT: 1.0]: ") or "1.0"
-    RADNKG = input("outer radius for NKG lat.dens.distr. [DEFAULT: 200.E2]: ") or "200.E2"
-    LONGI = input("longit.distr. & step size & fit & outfile [DEFAULT: T    10. T   T]: ") or "T    10. T   T"
-    ECTMAP = input("cut on gamma factor for printout [DEFAULT: 1.E11]: ") or "1.E11"
-    MAXPRT = input("max. number of printed events [DEFAULT: 1]: ") or "1"
-    DEBUG = input("debug flag and log.unit for out [DEFAULT: F  6   F   1000000]: ") or "F  6   F   1000000"
-    
-    # Generate file content
-    user_content = f"""RUNNR   {RUNNR} run number
+import numpy as np
+
+# Card parameters asked by generate_input_file(): (name, prompt, default)
+CARD_FIELDS = [
+    ("RUNNR", "run number [DEFAULT: 1]", "1"),
+    ("NSHOW", "number of showers to generate [DEFAULT: 1]", "1"),
+    ("PRMPAR", "prim. particle (1=gamma, 14=proton, 5626=iron, ...) [DEFAULT: 14]", "14"),
+    ("ESLOPE", "slope of primary energy spectrum [DEFAULT: -2.7]", "-2.7"),
+    ("ERANGE", "energy range of primary particle (GeV) [DEFAULT: 1.E3   1.E3]", "1.E3  1.E3"),
+    ("THETAP", "range of zenith angle (degree) [DEFAULT: 0. 0.]", "0.  0."),
+    ("PHIP", "range of azimuth angle (degree) [DEFAULT: -180.   180.]", "-180. 180."),
+    ("SEED1", "seed for 1. random number sequence [DEFAULT: 1   0   0]", "1    0   0"),
+    ("SEED2", "seed for 2. random number sequence [DEFAULT: 2   0   0]", "2    0   0"),
+    ("OBSLEV", "observation level (in cm) [DEFAULT: 0.]", "0."),
+    ("MAGNET", "magnetic field centr. Europe [DEFAULT: 20.0 42.8]", "20.0  42.8"),
+    ("HADFLG", "flags hadr.interact.&fragmentation [DEFAULT: 0  0   0   0   0   2]", "0    0   0   0   0   2"),
+    ("ECUTS", "energy cuts for particles [DEFAULT: 1.   1.  0.001   0.001]", "1.   1.  0.001   0.001"),
+    ("MUADDI", "additional info for muons (T/F) [DEFAULT: T]", "T"),
+    ("MUMULT", "muon multiple scattering angle (T/F) [DEFAULT: T]", "T"),
+    ("ELMFLG", "em. interaction flags (NKG,EGS) [DEFAULT: T T]", "T    T"),
+    ("STEPFC", "mult. scattering step length fact [DEFAULT: 1.0]", "1.0"),
+    ("RADNKG", "outer radius for NKG lat.dens.distr. [DEFAULT: 200.E2]", "200.E2"),
+    ("LONGI", "longit.distr. & step size & fit & outfile [DEFAULT: T    10. T   T]", "T    10. T   T"),
+    ("ECTMAP", "cut on gamma factor for printout [DEFAULT: 1.E11]", "1.E11"),
+    ("MAXPRT", "max. number of printed events [DEFAULT: 1]", "1"),
+    ("DEBUG", "debug flag and log.unit for out [DEFAULT: F  6   F   1000000]", "F  6   F   1000000")
+]
+
+CARD_TEMPLATE = """RUNNR   {RUNNR} run number
 NSHOW   {NSHOW} number of showers to generate
 PRMPAR  {PRMPAR}    prim. particle (1=gamma, 14=proton, ...)
 ESLOPE  {ESLOPE}    slope of primary energy spectrum
@@ -53,13 +71,13 @@ ELMFLG  {ELMFLG}    em. interaction flags (NKG,EGS)
 STEPFC  {STEPFC}    mult. scattering step length fact
 RADNKG  {RADNKG}    outer radius for NKG lat.dens.distr.
 PLOTSH  T
-EPOPAR  input   ../epos/epos.param  !initialization input file for epos
-EPOPAR  fname   pathnx  ../epos/    !initialization input file for epos
-EPOPAR  fname   inics   ../epos/epos.inics  !initialization input file for epos
-EPOPAR  fname   iniev   ../epos/epos.iniev  !initialization input file for epos
-EPOPAR  fname   initl   ../epos/epos.initl  !initialization input file for epos
-EPOPAR  fname   inirj   ../epos/epos.inirj  !initialization input file for epos
-EPOPAR  fname   hpf ../epos/urqmd34/tables.dat
+EPOPAR  input   {EPOS}epos.param  !initialization input file for epos
+EPOPAR  fname   pathnx  {EPOS}    !initialization input file for epos
+EPOPAR  fname   inics   {EPOS}epos.inics  !initialization input file for epos
+EPOPAR  fname   iniev   {EPOS}epos.iniev  !initialization input file for epos
+EPOPAR  fname   initl   {EPOS}epos.initl  !initialization input file for epos
+EPOPAR  fname   inirj   {EPOS}epos.inirj  !initialization input file for epos
+EPOPAR  fname   hpf {EPOS}urqmd34/tables.dat
 EPOPAR  fname   check   none    !dummy output file for epos
 EPOPAR  fname   histo   none    !dummy output file for epos
 EPOPAR  fname   data    none    !dummy output file for epos
@@ -73,10 +91,26 @@ USER    you user
 DEBUG   {DEBUG} debug flag and log.unit for out
 EXIT    terminates input
 """
+
+def card_content(params: dict, epos_dir="../epos/") -> str:
+    """Returns the CORSIKA input card for the given parameters, using defaults for missing ones."""
+    values = {name: default for name, _, default in CARD_FIELDS}
+    values.update({name: str(value) for name, value in params.items()})
+    return CARD_TEMPLATE.format(EPOS=epos_dir, **values)
+
+def generate_input_file():
+    """Generates the input file for CORSIKA simulation."""
+    print("\nPlease fill in the following fields (use TAB to separate multiple options):\n")
+    
+    # Collect user parameters
+    params = {}
+    for name, prompt, default in CARD_FIELDS:
+        params[name] = input(f"{prompt}: ") or default
     
     # Save the file
     with open("user_card", "w") as file:
-        file.write(user_content)
+        file.write(card_content(params))
+    return params
 
 def execute_command(command: str) -> str:
     """Executes a shell command and handles errors."""
@@ -89,38 +123,347 @@ def execute_command(command: str) -> str:
         print(f"Command error: {e.stderr}")
         sys.exit(1)
 
-def plottracks(runnr):
-    """Runs plottracks with interactive option selection."""
-    run_number_str = f"{runnr:06d}"
-    
-    # Check required files first
-    required_files = [
-        f"DAT{run_number_str}.track_em",
-        f"DAT{run_number_str}.track_mu", 
-        f"DAT{run_number_str}.track_hd"
-    ]
-    
-    missing_files = [f for f in required_files if not os.path.exists(f)]
+CACHE_DIR = ".workflow_cache"
+CACHE_LIMIT_MB = 20480
+
+def file_identity(path, content=True) -> str:
+    """Returns a digest of a file's content, or of its path, size and mtime for large binaries."""
+    if not content:
+        info = os.stat(path)
+        return f"{os.path.abspath(path)}:{info.st_size}:{info.st_mtime_ns}"
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def stage_key(name: str, params=None, inputs=(), binaries=(), upstream=()) -> str:
+    """Hashes everything a stage depends on: parameters, input files, executables and upstream stages."""
+    digest = hashlib.sha256(name.encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for path in inputs:
+        digest.update(file_identity(path).encode())
+    for path in binaries:
+        digest.update((file_identity(path, content=False) if path and os.path.exists(path) else str(path)).encode())
+    for key in upstream:
+        digest.update(key.encode())
+    return digest.hexdigest()
+
+def link_or_copy(source, destination):
+    """Hard-links a file, copying it when linking is not possible."""
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def collect_outputs(patterns: list, directory: str):
+    """Moves the files matching patterns into directory, replacing existing files and merging directories.
+
+    Outputs restored from the cache may be hard links to the files already
+    collected by an earlier attempt; those are simply removed.
+    """
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    if paths:
+        os.makedirs(directory, exist_ok=True)
+    for path in paths:
+        target = os.path.join(directory, os.path.basename(path))
+        if os.path.isdir(path) and not os.path.islink(path):
+            collect_outputs([os.path.join(glob.escape(path), '*')], target)
+            os.rmdir(path)
+        elif os.path.exists(target) and os.path.samefile(path, target):
+            os.remove(path)
+        else:
+            os.replace(path, target)
+
+def run_stage(name: str, key: str, outputs: list, action, cache_dir=CACHE_DIR, report=None, inputs=()) -> str:
+    """Runs a pipeline stage unless its outputs are already cached under the same key.
+
+    outputs are glob patterns of the files the stage writes to the working
+    directory; they are stored in cache_dir/<key> once the stage succeeds and
+    restored from there on later runs. A cache_dir of None disables caching.
+    The stage is timed into report, with inputs as glob patterns of the files it reads.
+    """
+    with stage_timer(report, name, inputs, outputs) as record:
+        record['cached'] = cache_stage(name, key, outputs, action, cache_dir)
+    return key
+
+def cache_stage(name: str, key: str, outputs: list, action, cache_dir) -> bool:
+    """Restores or runs and stores a stage for run_stage(), telling whether it was cached."""
+    entry = os.path.join(cache_dir, key) if cache_dir else None
+    manifest = os.path.join(entry, 'manifest.json') if entry else None
+    if manifest and os.path.exists(manifest):
+        with open(manifest, 'r') as file:
+            for file_name in json.load(file):
+                link_or_copy(os.path.join(entry, file_name), file_name)
+        # Marks the entry as recently used for prune_cache()
+        os.utime(manifest)
+        print(f"  Stage {name}: outputs restored from cache ({key[:12]}), skipping")
+        return True
+
+    # Stale outputs may be hard links into another cache entry, never write through them
+    for pattern in outputs:
+        for file_name in glob.glob(pattern):
+            os.remove(file_name)
+    action()
+    if not entry:
+        return False
+
+    produced = sorted({file_name for pattern in outputs for file_name in glob.glob(pattern)})
+    partial = entry + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    for file_name in produced:
+        link_or_copy(file_name, os.path.join(partial, file_name))
+    with open(os.path.join(partial, 'manifest.json'), 'w') as file:
+        json.dump(produced, file)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.rename(partial, entry)
+    return False
+
+def prune_cache(cache_dir, limit_mb=CACHE_LIMIT_MB):
+    """Removes the least recently used stage outputs until the cache holds at most limit_mb MB.
+
+    Entries left incomplete by an interrupted stage are always removed.
+    """
+    entries = []
+    for entry in glob.glob(os.path.join(cache_dir, '*')):
+        manifest = os.path.join(entry, 'manifest.json')
+        if not os.path.exists(manifest):
+            shutil.rmtree(entry, ignore_errors=True)
+            continue
+        size = sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(entry) for name in files)
+        entries.append((os.path.getmtime(manifest), size, entry))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry in sorted(entries):
+        if total <= limit_mb * 2**20:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+    if removed:
+        print(f"  Cache {cache_dir}: removed {removed} least recently used stage(s), {total / 2**20:.0f} MB kept")
+
+REPORT_FILE = "run_report.json"
+REPORT_LOCK = threading.Lock()
+# CPU time of the calling thread only, so that concurrent stages are told apart
+RUSAGE_STAGE = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+# Stages running now and started so far, to tell whether a stage ran alone,
+# and the peak RSS before the last reset, which also resets getrusage's
+STAGE_COUNTS = {'running': 0, 'started': 0, 'peak_rss_kb': 0}
+
+def reset_peak_rss() -> bool:
+    """Resets the peak resident set size of this process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process since the last reset, in KiB."""
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def file_bytes(patterns) -> int:
+    """Returns the total size of the files matching the glob patterns."""
+    files = {file_name for pattern in patterns for file_name in glob.glob(pattern)}
+    return sum(os.path.getsize(file_name) for file_name in files if os.path.isfile(file_name))
+
+def new_report(path: str, **info) -> dict:
+    """Starts a run report that is written to path every time a stage finishes."""
+    return dict(info, path=path, host=platform.node(), started=time.strftime('%Y-%m-%dT%H:%M:%S'), stages=[])
+
+@contextlib.contextmanager
+def stage_timer(report, name: str, inputs=(), outputs=()):
+    """Records wall time, CPU time, peak memory and file sizes of a pipeline stage in the report.
+
+    peak_rss_kb is the peak RSS of this process during the stage, measured
+    (on Linux) only when no other stage ran at the same time, and None
+    otherwise. workflow_peak_rss_kb and children_lifetime_peak_rss_kb are the
+    getrusage high-water marks since the start of the workflow, for this
+    process and for its largest finished child. CPU time is that of the
+    stage's thread, but child process times also include other stages
+    running at the same time.
+    """
+    record = {'stage': name, 'input_bytes': file_bytes(inputs)}
+    with REPORT_LOCK:
+        STAGE_COUNTS['running'] += 1
+        STAGE_COUNTS['started'] += 1
+        started = STAGE_COUNTS['started']
+        alone = False
+        if STAGE_COUNTS['running'] == 1:
+            STAGE_COUNTS['peak_rss_kb'] = max(STAGE_COUNTS['peak_rss_kb'], peak_rss_kb() or 0)
+            alone = reset_peak_rss()
+    own = resource.getrusage(RUSAGE_STAGE)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    try:
+        yield record
+        record.setdefault('status', 'ok')
+    finally:
+        record.setdefault('status', 'failed')
+        record['wall_s'] = time.perf_counter() - start
+        own_after = resource.getrusage(RUSAGE_STAGE)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record['cpu_user_s'] = own_after.ru_utime - own.ru_utime
+        record['cpu_system_s'] = own_after.ru_stime - own.ru_stime
+        record['children_cpu_user_s'] = children_after.ru_utime - children.ru_utime
+        record['children_cpu_system_s'] = children_after.ru_stime - children.ru_stime
+        with REPORT_LOCK:
+            STAGE_COUNTS['running'] -= 1
+            # Read before another stage can start and reset the mark
+            record['peak_rss_kb'] = peak_rss_kb() if alone and STAGE_COUNTS['started'] == started else None
+            record['workflow_peak_rss_kb'] = max(STAGE_COUNTS['peak_rss_kb'], own_after.ru_maxrss)
+        record['children_lifetime_peak_rss_kb'] = children_after.ru_maxrss
+        record['output_bytes'] = file_bytes(outputs)
+        if report is not None:
+            with REPORT_LOCK:
+                report['stages'].append(record)
+                with open(report['path'], 'w') as file:
+                    json.dump({key: value for key, value in report.items() if key != 'path'}, file, indent=2)
+
+def summarize_reports(pattern=f"data_run_*/{REPORT_FILE}"):
+    """Prints per-stage statistics aggregated over the reports of many runs."""
+    stages = {}
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r') as file:
+            for record in json.load(file)['stages']:
+                if record['status'] == 'ok' and not record.get('cached'):
+                    stages.setdefault(record['stage'], []).append(record)
+    if not stages:
+        print(f"No completed stages found in {pattern}")
+        return {}
+
+    summary = {}
+    print(f"\n{'stage':<12} {'runs':>5} {'wall mean':>10} {'wall max':>10} {'cpu mean':>10} {'rss max MB':>11} {'in MB':>10} {'out MB':>10}")
+    for name, records in stages.items():
+        column = lambda key: np.array([record[key] for record in records], dtype=float)
+        cpu = column('cpu_user_s') + column('cpu_system_s') + column('children_cpu_user_s') + column('children_cpu_system_s')
+        # Stages that overlapped others have no peak of their own (NaN)
+        rss = column('peak_rss_kb')
+        summary[name] = {
+            'runs': len(records),
+            'wall_mean_s': column('wall_s').mean(),
+            'wall_max_s': column('wall_s').max(),
+            'cpu_mean_s': cpu.mean(),
+            'peak_rss_max_kb': np.fmax.reduce(rss),
+            'input_mean_bytes': column('input_bytes').mean(),
+            'output_mean_bytes': column('output_bytes').mean()
+        }
+        row = summary[name]
+        print(f"{name:<12} {row['runs']:>5} {row['wall_mean_s']:>10.1f} {row['wall_max_s']:>10.1f} {row['cpu_mean_s']:>10.1f} "
+              f"{row['peak_rss_max_kb'] / 1024:>11.1f} {row['input_mean_bytes'] / 2**20:>10.1f} {row['output_mean_bytes'] / 2**20:>10.1f}")
+    return summary
+
+def total_memory_mb() -> int:
+    """Returns the physical memory of the machine in MB."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+
+def stage_memory_mb(patterns, factor, base=64):
+    """Returns an estimate of a stage's memory from the size of the files it reads, for run_graph()."""
+    return lambda: base + factor * file_bytes(patterns) // 2**20
+
+def run_graph(nodes: dict, cpus=None, memory_mb=None) -> dict:
+    """Runs a dependency graph of stages, each as soon as its dependencies are done and slots are free.
+
+    nodes maps stage names to dicts with the stage 'action', the names it runs
+    'after' and the 'cpus' and 'memory_mb' it holds while running (memory_mb
+    may be a callable, evaluated once the stage is ready). A failed stage
+    cancels the stages depending on it while independent branches carry on.
+    Returns the status of every stage: ok, failed or cancelled.
+    """
+    cpus = cpus or os.cpu_count() or 1
+    memory_mb = memory_mb or total_memory_mb()
+    unknown = {dependency for node in nodes.values() for dependency in node.get('after', ()) if dependency not in nodes}
+    if unknown:
+        print(f"Error: Unknown stage dependencies: {', '.join(sorted(unknown))}")
+        sys.exit(1)
+
+    status = {}
+    pending = dict(nodes)
+    running = {}
+    free_cpus, free_memory = cpus, memory_mb
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(nodes))) as pool:
+        while pending or running:
+            # Cancellations propagate down the graph whatever the order of the stages
+            scan = True
+            while scan:
+                scan = False
+                for name, node in list(pending.items()):
+                    after = [status.get(dependency) for dependency in node.get('after', ())]
+                    if any(state in ('failed', 'cancelled') for state in after):
+                        status[name] = 'cancelled'
+                        del pending[name]
+                        scan = True
+                        print(f"  Stage {name} cancelled after a failed dependency")
+                    elif all(state == 'ok' for state in after):
+                        # A stage larger than the machine runs alone rather than never
+                        need_cpus = min(node.get('cpus', 1), cpus)
+                        need_memory = node.get('memory_mb', 0)
+                        need_memory = min(need_memory() if callable(need_memory) else need_memory, memory_mb)
+                        if need_cpus <= free_cpus and need_memory <= free_memory:
+                            free_cpus -= need_cpus
+                            free_memory -= need_memory
+                            running[pool.submit(node['action'])] = (name, need_cpus, need_memory)
+                            del pending[name]
+            if not running:
+                # Only stages waiting on each other are left
+                for name in pending:
+                    status[name] = 'cancelled'
+                    print(f"  Stage {name} cancelled: circular dependency")
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, used_cpus, used_memory = running.pop(future)
+                free_cpus += used_cpus
+                free_memory += used_memory
+                try:
+                    future.result()
+                    status[name] = 'ok'
+                except (Exception, SystemExit) as error:
+                    status[name] = 'failed'
+                    print(f"Error: Stage {name} failed ({error!r})")
+    return status
+
+def missing_tracks(runnr) -> list:
+    """Returns the track files of a run that do not exist, after reporting them."""
+    missing_files = [datafile for datafile, results in track_files(runnr)
+                     if not os.path.exists(datafile) and not os.path.exists(f"{results}.npy")]
     if missing_files:
         print(f"\nError: Track files not found: {', '.join(missing_files)}")
-        return []
+    return missing_files
 
+def ask_plottracks(native=False):
+    """Asks the plottracks options, returning None if the user cancels."""
     # Ask for confirmation before proceeding with questions
     confirm = input("\nDo you want to run plottracks? (y/n) [DEFAULT: y]: ").lower() or "y"
     if confirm != 'y':
         print("Plottracks execution canceled by user.")
-        return []
+        return None
 
     # 1. Projection selection
     print("\n[1] Projection type:")
     print("  1 = x-z")
     print("  2 = y-z")
     print("  3 = x-y")
-    while True:
+    while not native:
         projection = input("  Choose (1-3) [DEFAULT: 1]: ") or "1"
         if projection in ['1', '2', '3']:
             break
         print("  Invalid option! Choose 1, 2 or 3.")
+    if native:
+        projection = "all"
+        print("  The built-in rasterizer draws all three projections.")
 
     # 2. View radius
     print("\n[2] View radius (in km):")
@@ -161,43 +504,73 @@ def plottracks(runnr):
         else:
             print("  Incorrect format! Enter 3 values separated by spaces.")
 
+    # 5. Density images
+    density = 'n'
+    if native:
+        print("\n[5] Density-weighted images (shade pixels by the number of tracks crossing them):")
+        while True:
+            density = input("  Choose (y/n) [DEFAULT: n]: ").lower() or "n"
+            if density in ['y', 'n']:
+                break
+            print("  Invalid option! Choose 'y' or 'n'.")
+
     # Show summary and final confirmation
     print("\n" + "-"*60)
     print("Selected options summary:")
-    print(f"  Projection: {'x-z' if projection == '1' else 'y-z' if projection == '2' else 'x-y'}")
+    print(f"  Projection: {'x-z' if projection == '1' else 'y-z' if projection == '2' else 'x-y' if projection == '3' else 'x-z, y-z and x-y'}")
     print(f"  Radius: {radius} km")
     print(f"  Background: {'Black' if background == 'b' else 'White'}")
     print(f"  Energy cuts: {energy_cuts}")
+    if native:
+        print(f"  Density images: {'Yes' if density == 'y' else 'No'}")
     print("-"*60)
     
     final_confirm = input("\nRun plottracks with these settings? (y/n) [DEFAULT: y]: ").lower() or "y"
     if final_confirm != 'y':
         print("Execution canceled by user.")
+        return None
+    return {'projection': projection, 'radius': radius, 'background': background, 'energy_cuts': energy_cuts, 'density': density}
+
+def draw_tracks(runnr, options, native=False, report=None):
+    """Runs plottracks, or the built-in track rasterizer, with the options from ask_plottracks()."""
+    run_number_str = f"{runnr:06d}"
+    required_files = [datafile for datafile, _ in track_files(runnr)]
+    if missing_tracks(runnr):
         return []
+    projection, radius, background, energy_cuts, density = (
+        options[name] for name in ['projection', 'radius', 'background', 'energy_cuts', 'density'])
+
+    if native:
+        print("\nRasterizing tracks...")
+        with stage_timer(report, "plottracks", required_files, [f"track{run_number_str}.*.png"]):
+            return rasterize_tracks(runnr, float(radius), background, [float(x) for x in energy_cuts.split()], density == 'y')
 
     # Build input sequence
     input_sequence = f"{projection}\n{radius}\n{background}\n{energy_cuts}\n{run_number_str}\n"
 
     # Execute plottracks
-    try:
-        print("\nRunning plottracks...")
-        result = subprocess.run(
-            f"echo '{input_sequence}' | ./plottracks",
-            shell=True,
-            check=True,
-            text=True,
-            capture_output=True,
-            timeout=30
-        )
-        print(result.stdout)
-    except subprocess.TimeoutExpired:
-        print("  Warning: plottracks exceeded execution time limit")
-        return []
-    except subprocess.CalledProcessError as e:
-        print(f"\nError executing plottracks (status {e.returncode}):")
-        print(f"Output: {e.stdout}")
-        print(f"Error: {e.stderr}")
-        return []
+    with stage_timer(report, "plottracks", required_files, [f"track{run_number_str}.*.ppm"]) as record:
+        try:
+            print("\nRunning plottracks...")
+            result = subprocess.run(
+                f"echo '{input_sequence}' | ./plottracks",
+                shell=True,
+                check=True,
+                text=True,
+                capture_output=True,
+                timeout=30
+            )
+            print(result.stdout)
+        except subprocess.TimeoutExpired:
+            print("  Warning: plottracks exceeded execution time limit")
+            record['status'] = 'timeout'
+            return []
+        except subprocess.CalledProcessError as e:
+            print(f"\nError executing plottracks (status {e.returncode}):")
+            print(f"Output: {e.stdout}")
+            print(f"Error: {e.stderr}")
+            record['status'] = 'failed'
+            return []
 
     # Process outputs
     output_files = []
@@ -222,53 +595,1004 @@ def plottracks(runnr):
 
     return output_files
 
-def tracks2root(runnr=1):
-    """Converts binary track files to text."""
+# Fortran unformatted record of a CORSIKA PLOTSH track file: 4-byte record
+# length, 10 float32 values (particle, energy, start x/y/z/t, end x/y/z/t)
+# and the trailing 4-byte record length.
+TRACK_FIELDS = ['particle', 'energy', 'x', 'y', 'z', 't', 'xend', 'yend', 'zend', 'tend']
+TRACK_RECORD_DTYPE = np.dtype([('head', 'i4')] + [(name, 'f4') for name in TRACK_FIELDS] + [('tail', 'i4')])
+TRACK_DTYPE = np.dtype([(name, 'f4') for name in TRACK_FIELDS])
+TRACK_PAYLOAD_BYTES = 4 * len(TRACK_FIELDS)
+CHUNK_RECORDS = 1 << 20
+
+def track_files(runnr):
+    """Returns the (input, output) names of the em, mu and hd track files."""
     run_number_str = f"{runnr:06d}"
-    
-    content = f"""import struct
+    return [
+        (f"DAT{run_number_str}.track_em", "EDresults_em"),
+        (f"DAT{run_number_str}.track_mu", "EDresults_mu"),
+        (f"DAT{run_number_str}.track_hd", "EDresults_hd")
+    ]
 
-files = [
-    {{"input": "DAT{run_number_str}.track_mu", "output": "results_mu"}},
-    {{"input": "DAT{run_number_str}.track_em", "output": "results_em"}},
-    {{"input": "DAT{run_number_str}.track_hd", "output": "results_hd"}}
-]
+def map_tracks(datafile):
+    """Memory-maps a binary track file as an array of Fortran records."""
+    size = os.path.getsize(datafile)
+    if size % TRACK_RECORD_DTYPE.itemsize:
+        print(f"Error: {datafile} is not a sequence of {TRACK_RECORD_DTYPE.itemsize}-byte track records")
+        sys.exit(1)
+    if size == 0:
+        return np.empty(0, dtype=TRACK_RECORD_DTYPE)
+    return np.memmap(datafile, dtype=TRACK_RECORD_DTYPE, mode='r')
+
+def write_npy_header(outfile, dtype, count, length=None):
+    """Writes a 1-D .npy header at the start of the file, padded to length bytes."""
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': (count,)
+    })
+    header = header.getvalue()
+    if length is not None and len(header) < length:
+        # Magic string, version and header length take the first 10 bytes
+        text = header[10:-1] + b' ' * (length - len(header)) + b'\n'
+        header = header[:8] + struct.pack('<H', len(text)) + text
+    outfile.seek(0)
+    outfile.write(header)
+    return len(header)
+
+def decode_chunk(chunk, datafile, start):
+    """Validates a chunk of track records and drops degenerate segments."""
+    if np.any(chunk['head'] != TRACK_PAYLOAD_BYTES) or np.any(chunk['tail'] != TRACK_PAYLOAD_BYTES):
+        print(f"Error: Corrupted record markers in {datafile} after record {start}")
+        sys.exit(1)
+    # Segments that do not move in x cannot be drawn as a curve
+    valid = chunk['x'] != chunk['xend']
+    decoded = np.empty(np.count_nonzero(valid), dtype=TRACK_DTYPE)
+    for name in TRACK_FIELDS:
+        decoded[name] = chunk[name][valid]
+    return decoded
+
+def write_decoded(chunks, datafile, results, capacity, text=False, energy_cut=0., budget=0, strategy=None, seed=0):
+    """Decodes (start, records) chunks of a track file into results.npy, returning (kept, read) counts.
 
-for file in files:
-    datafile = file["input"]
-    results = file["output"]
+    capacity bounds the number of segments, to reserve room for the header.
+    Segments below energy_cut are dropped. With a budget and a strategy that
+    can be applied chunk by chunk (energy or reservoir), only the running
+    selection is kept, in memory, and written in file order at the end.
+    """
+    select = budget > 0 and strategy in STREAMED_STRATEGIES
+    rng = np.random.default_rng(seed)
+    selected, priorities = np.empty(0, dtype=TRACK_DTYPE), np.empty(0)
+    kept = read = 0
+    with open(f"{results}.npy", 'wb') as npyfile, open(results if text else os.devnull, 'w') as outfile:
+        def write(decoded):
+            npyfile.write(decoded.tobytes())
+            if text:
+                np.savetxt(outfile, decoded.view(('f4', len(TRACK_FIELDS))), fmt='%.9g')
+            return len(decoded)
+
+        # Reserve room for the largest possible shape, fixed up once the count is known
+        header_length = write_npy_header(npyfile, TRACK_DTYPE, capacity)
+        for start, records in chunks:
+            decoded = decode_chunk(records, datafile, start)
+            decoded = decoded[decoded['energy'] >= energy_cut]
+            read += len(records)
+            if not select:
+                kept += write(decoded)
+                continue
+            # The budget segments of highest priority so far, still in file order
+            selected = np.concatenate([selected, decoded])
+            priorities = np.concatenate([priorities, decoded['energy'] if strategy == 'energy' else rng.random(len(decoded))])
+            if len(selected) > budget:
+                keep = np.sort(np.argpartition(-priorities, budget - 1)[:budget])
+                selected, priorities = selected[keep], priorities[keep]
+        if select:
+            kept += write(selected)
+        write_npy_header(npyfile, TRACK_DTYPE, kept, header_length)
+    return kept, read
+
+def decode_tracks(runnr=1, text=False, chunk_records=CHUNK_RECORDS, classes=('em', 'mu', 'hd')):
+    """Converts binary track files to filtered .npy arrays, optionally exporting text.
+
+    classes selects the track files to convert (em, mu and/or hd).
+    """
+    outputs = []
+    for datafile, results in track_files(runnr):
+        if datafile.rsplit('_', 1)[1] not in classes:
+            continue
+        if not os.path.exists(datafile):
+            print(f"  Warning: Track file {datafile} not found. Skipping.")
+            continue
+        records = map_tracks(datafile)
+        chunks = ((start, records[start:start + chunk_records]) for start in range(0, len(records), chunk_records))
+        kept, _ = write_decoded(chunks, datafile, results, len(records), text)
+        print(f"  {datafile}: kept {kept} of {len(records)} segments")
+        outputs.append(f"{results}.npy")
+    return outputs
 
-    with open(datafile, "rb") as infile, open(results, "w") as outfile:
+# Header room for streamed track files, whose length is not known in advance
+STREAM_CAPACITY = 10**15
+
+def stream_records(datafile, finished, chunk_records=CHUNK_RECORDS):
+    """Yields (start, records) chunks of a track file while CORSIKA is still writing it.
+
+    datafile is either a FIFO, read until CORSIKA closes it, or a regular file
+    that is followed until finished() tells that CORSIKA has exited.
+    """
+    record_size = TRACK_RECORD_DTYPE.itemsize
+    while not os.path.exists(datafile) and not finished():
+        time.sleep(0.2)
+    if not os.path.exists(datafile):
+        return
+    fifo = stat.S_ISFIFO(os.stat(datafile).st_mode)
+    buffer = bytearray()
+    start = 0
+    with open(datafile, 'rb', buffering=0) as file:
         while True:
-            buffer2 = infile.read(48)
-            if not buffer2:
+            # Anything written before CORSIKA exited is read before stopping
+            done = finished()
+            data = file.read(chunk_records * record_size - len(buffer))
+            if not data:
+                if fifo or done:
+                    break
+                time.sleep(0.2)
+                continue
+            buffer += data
+            whole = len(buffer) - len(buffer) % record_size
+            if whole:
+                records = np.frombuffer(bytes(buffer[:whole]), dtype=TRACK_RECORD_DTYPE)
+                del buffer[:whole]
+                yield start, records
+                start += len(records)
+    if buffer:
+        print(f"Error: {datafile} ends with an incomplete record after record {start}")
+        sys.exit(1)
+
+def stream_tracks(runnr, simulate, follow=False, text=False, chunk_records=CHUNK_RECORDS,
+                  budgets=(0, 0, 0), strategy='stratified', energy_cuts=(0., 0., 0.)):
+    """Runs simulate() while decoding the track files into EDresults_*.npy as CORSIKA writes them.
+
+    The track files are replaced by named pipes, so the binary tracks never
+    reach the disk, or with follow they are regular files read as they grow.
+    The em, mu and hd energy cuts are applied while decoding, and so are the
+    budgets with the energy and reservoir strategies; the stratified sample
+    is still drawn by the decimation stage. Returns the result of simulate().
+    """
+    pairs = track_files(runnr)
+    for datafile, _ in pairs:
+        if os.path.lexists(datafile):
+            os.remove(datafile)
+        if not follow:
+            os.mkfifo(datafile)
+    finished = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(pairs)) as pool:
+        decoders = {pool.submit(write_decoded, stream_records(datafile, finished.is_set, chunk_records),
+                                datafile, results, STREAM_CAPACITY, text, energy_cut, budget, strategy): datafile
+                    for (datafile, results), budget, energy_cut in zip(pairs, budgets, energy_cuts)}
+        try:
+            result = simulate()
+        finally:
+            finished.set()
+            errors = []
+            for future, datafile in decoders.items():
+                # A decoder still waiting for CORSIKA to open its pipe gets an empty stream instead
+                while not follow and not future.done():
+                    try:
+                        os.close(os.open(datafile, os.O_WRONLY | os.O_NONBLOCK))
+                    except OSError:
+                        pass
+                    time.sleep(0.1)
+                # Every decoder is waited for before a failure is passed on
+                try:
+                    kept, read = future.result()
+                except (SystemExit, Exception) as error:
+                    errors.append(error)
+                    print(f"  {datafile}: decoding failed ({error})")
+                    continue
+                print(f"  {datafile}: kept {kept} of {read} streamed segments")
+            if not follow:
+                for datafile, _ in pairs:
+                    if os.path.lexists(datafile):
+                        os.remove(datafile)
+    if errors:
+        raise errors[0]
+    return result
+
+# Projection name -> (horizontal, vertical) coordinates, as drawn by plottracks
+PROJECTIONS = {'xz': ('x', 'z'), 'yz': ('y', 'z'), 'xy': ('x', 'y')}
+PLOT_COLORS = {'em': (1.0, 0.0, 0.0), 'mu': (0.0, 0.7, 0.0), 'had': (0.0, 0.0, 1.0)}
+MAX_RASTER_SAMPLES = 1 << 24
+
+def write_png(path, image):
+    """Writes an RGB uint8 image as a PNG file."""
+    height, width, _ = image.shape
+    # Every scanline starts with filter type 0 (none)
+    raw = np.zeros((height, 1 + 3 * width), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, 3 * width)
+    chunk = lambda tag, data: struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    with open(path, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        file.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        file.write(chunk(b'IEND', b''))
+
+def raster_segments(grid, start, end, extent):
+    """Adds one count per pixel crossed by each 2D segment to grid.
+
+    start and end are (horizontal, vertical) coordinate arrays and extent is
+    (hmin, hmax, vmin, vmax); the top row of the grid is vmax.
+    """
+    rows, columns = grid.shape
+    hmin, hmax, vmin, vmax = extent
+    h0 = (start[0] - hmin) / (hmax - hmin) * columns
+    h1 = (end[0] - hmin) / (hmax - hmin) * columns
+    v0 = (vmax - start[1]) / (vmax - vmin) * rows
+    v1 = (vmax - end[1]) / (vmax - vmin) * rows
+    # Skip segments whose bounding box misses the image
+    visible = ((np.maximum(h0, h1) >= 0) & (np.minimum(h0, h1) < columns) &
+               (np.maximum(v0, v1) >= 0) & (np.minimum(v0, v1) < rows))
+    h0, h1, v0, v1 = h0[visible], h1[visible], v0[visible], v1[visible]
+    # Clip every segment to the image (Liang-Barsky), so long segments are sampled once per pixel they cross
+    dh, dv = h1 - h0, v1 - v0
+    low, high = np.zeros(len(h0)), np.ones(len(h0))
+    for origin, delta, size in ((h0, dh, columns), (v0, dv, rows)):
+        # Segments parallel to an edge were already kept or dropped by the bounding box test
+        moving = delta != 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            near, far = -origin / delta, (size - origin) / delta
+        low = np.where(moving, np.maximum(low, np.minimum(near, far)), low)
+        high = np.where(moving, np.minimum(high, np.maximum(near, far)), high)
+    crossing = low <= high
+    h0, h1 = (h0 + low * dh)[crossing], (h0 + high * dh)[crossing]
+    v0, v1 = (v0 + low * dv)[crossing], (v0 + high * dv)[crossing]
+    # Samples less than a pixel apart, so that rounding never skips a pixel
+    steps = np.floor(np.maximum(np.abs(h1 - h0), np.abs(v1 - v0))).astype(np.int64) + 2
+    # Sample every segment about once per pixel, in slices of bounded size
+    cumulative = np.cumsum(steps)
+    first = 0
+    while first < len(steps):
+        done = cumulative[first - 1] if first else 0
+        last = max(first + 1, int(np.searchsorted(cumulative, done + MAX_RASTER_SAMPLES, side='right')))
+        count = steps[first:last]
+        segment = np.repeat(np.arange(first, last), count)
+        offset = np.arange(len(segment)) - np.repeat(np.cumsum(count) - count, count)
+        fraction = offset / np.maximum(steps[segment] - 1, 1)
+        h = (h0[segment] + fraction * (h1[segment] - h0[segment])).astype(np.int64)
+        v = (v0[segment] + fraction * (v1[segment] - v0[segment])).astype(np.int64)
+        inside = (h >= 0) & (h < columns) & (v >= 0) & (v < rows)
+        grid += np.bincount(v[inside] * columns + h[inside], minlength=grid.size).reshape(grid.shape)
+        first = last
+
+def rasterize_tracks(runnr, radius=5., background='w', energy_cuts=(0., 0., 0.), density=False,
+                     width=1000, height=30., chunk_records=CHUNK_RECORDS):
+    """Draws the x-z, y-z and x-y projections of the em, mu, had and all tracks as PNG images.
+
+    The horizontal axes span radius km around the shower axis and the vertical
+    axis of x-z and y-z spans height km above sea level. All images are filled
+    in a single pass over the track files. With density, pixels are shaded by
+    the (logarithmic) number of tracks crossing them instead of by coverage.
+    """
+    run_number_str = f"{runnr:06d}"
+    radius_cm = radius * 1e5
+    extents = {
+        'xz': (-radius_cm, radius_cm, 0., height * 1e5),
+        'yz': (-radius_cm, radius_cm, 0., height * 1e5),
+        'xy': (-radius_cm, radius_cm, -radius_cm, radius_cm)
+    }
+    shapes = {name: (int(round(width * (vmax - vmin) / (hmax - hmin))), width)
+              for name, (hmin, hmax, vmin, vmax) in extents.items()}
+    grids = {particle: {name: np.zeros(shapes[name], dtype=np.int64) for name in PROJECTIONS} for particle in PLOT_COLORS}
+
+    for (datafile, results), particle, energy_cut in zip(track_files(runnr), PLOT_COLORS, energy_cuts):
+        if os.path.exists(datafile):
+            records = map_tracks(datafile)
+        elif os.path.exists(f"{results}.npy"):
+            # Streamed runs only keep the decoded tracks
+            records = np.load(f"{results}.npy", mmap_mode='r')
+        else:
+            print(f"  Warning: Track file {datafile} not found. Skipping.")
+            continue
+        for start in range(0, len(records), chunk_records):
+            chunk = records[start:start + chunk_records]
+            chunk = chunk[chunk['energy'] >= energy_cut]
+            for name, (horizontal, vertical) in PROJECTIONS.items():
+                raster_segments(grids[particle][name], (chunk[horizontal], chunk[vertical]),
+                                (chunk[horizontal + 'end'], chunk[vertical + 'end']), extents[name])
+
+    backdrop = np.array((0., 0., 0.) if background == 'b' else (1., 1., 1.))
+    output_files = []
+    for name in PROJECTIONS:
+        layers = {}
+        for particle, color in PLOT_COLORS.items():
+            counts = grids[particle][name]
+            if density:
+                alpha = np.log1p(counts) / max(np.log1p(counts.max()), 1.)
+            else:
+                alpha = (counts > 0).astype(float)
+            layers[particle] = (alpha[..., None], np.array(color))
+        for particle in list(PLOT_COLORS) + ['all']:
+            image = np.broadcast_to(backdrop, shapes[name] + (3,)).copy()
+            for layer in (layers.values() if particle == 'all' else [layers[particle]]):
+                alpha, color = layer
+                image = image * (1 - alpha) + color * alpha
+            png_file = f"track{run_number_str}.{particle}.{name}.png"
+            write_png(png_file, (image * 255).round().astype(np.uint8))
+            output_files.append(png_file)
+            print(f"  Generated: {png_file}")
+    return output_files
+
+def endpoint_keys(tracks, suffix=''):
+    """Returns the (x, y, z) start or end point of every segment as hashable bytes."""
+    points = np.empty((len(tracks), 3), dtype='f4')
+    for column, axis in enumerate(['x', 'y', 'z']):
+        points[:, column] = tracks[axis + suffix]
+    return points.view('V12').ravel().tolist()
+
+def chain_tracks(tracks):
+    """Connects segments whose end point is the start point of exactly one other segment.
+
+    Returns the segment indices in polyline order and the offsets where each
+    polyline starts in that order (with a final offset equal to its length).
+    """
+    count = len(tracks)
+    # Point -> segment index, or -1 when several segments share the point
+    start_index = {}
+    for index, key in enumerate(endpoint_keys(tracks)):
+        start_index[key] = -1 if key in start_index else index
+    end_index = {}
+    end_keys = endpoint_keys(tracks, 'end')
+    for index, key in enumerate(end_keys):
+        end_index[key] = -1 if key in end_index else index
+
+    successor = np.full(count, -1, dtype=np.int64)
+    has_predecessor = np.zeros(count, dtype=bool)
+    for index, key in enumerate(end_keys):
+        following = start_index.get(key, -1)
+        if following >= 0 and following != index and end_index[key] == index:
+            successor[index] = following
+            has_predecessor[following] = True
+
+    order = np.empty(count, dtype=np.int64)
+    offsets = [0]
+    visited = np.zeros(count, dtype=bool)
+    position = 0
+    # Heads first, then whatever is left over (closed loops) so every segment is used once
+    for head in np.concatenate([np.flatnonzero(~has_predecessor), np.arange(count)]).tolist():
+        if visited[head]:
+            continue
+        index = head
+        while index >= 0 and not visited[index]:
+            visited[index] = True
+            order[position] = index
+            position += 1
+            index = successor[index]
+        offsets.append(position)
+    return order, np.array(offsets, dtype=np.int64)
+
+def build_polylines(tracks):
+    """Chains track segments and returns the polylines as flat arrays."""
+    order, offsets = chain_tracks(tracks)
+    lengths = np.diff(offsets)
+    curves = len(lengths)
+    # Each polyline has the start of all its segments plus the end of the last one
+    curve_of_segment = np.repeat(np.arange(curves), lengths)
+    segment_slots = np.arange(len(order)) + curve_of_segment
+    end_slots = offsets[1:] + np.arange(curves)
+    last = order[offsets[1:] - 1]
+    points = np.empty((len(order) + curves, 3), dtype='f4')
+    for column, axis in enumerate(['x', 'y', 'z']):
+        points[segment_slots, column] = tracks[axis][order]
+        points[end_slots, column] = tracks[axis + 'end'][last]
+    first = order[offsets[:-1]]
+    return {
+        'points': points,
+        'offsets': offsets + np.arange(curves + 1),
+        'particle': tracks['particle'][first],
+        'energy': tracks['energy'][first],
+        't': tracks['t'][first],
+        'tend': tracks['tend'][last]
+    }
+
+DECIMATION_STRATEGIES = ['energy', 'stratified', 'reservoir']
+# Strategies that need no pass over the whole file, applied while streaming
+STREAMED_STRATEGIES = ['energy', 'reservoir']
+
+def fill_quotas(counts, budget):
+    """Splits a budget evenly across strata, handing unused shares of small strata to larger ones."""
+    if counts.sum() <= budget:
+        return counts
+    ordered = np.sort(counts)
+    # Level each stratum would get if every smaller stratum were kept whole
+    remaining = budget - np.concatenate([[0], np.cumsum(ordered)[:-1]])
+    levels = remaining / (len(ordered) - np.arange(len(ordered)))
+    level = int(levels[np.argmax(ordered >= levels)])
+    quotas = np.minimum(counts, level)
+    # Spread what rounding down left over across the strata that still have segments
+    candidates = np.flatnonzero(counts > quotas)
+    spare = budget - quotas.sum()
+    quotas[candidates[np.linspace(0, len(candidates) - 1, spare).astype(int)]] += 1
+    return quotas
+
+def select_top(tracks, quotas, priority, stratum, valid, chunk_records=CHUNK_RECORDS):
+    """Streams over the tracks keeping, per stratum, the quota segments of highest priority."""
+    kept_index = np.empty(0, dtype=np.int64)
+    kept_priority = np.empty(0)
+    kept_stratum = np.empty(0, dtype=np.int64)
+    for start in range(0, len(tracks), chunk_records):
+        chunk = tracks[start:start + chunk_records]
+        mask = valid(chunk)
+        index = np.concatenate([kept_index, start + np.flatnonzero(mask)])
+        priorities = np.concatenate([kept_priority, priority(chunk)[mask]])
+        strata = np.concatenate([kept_stratum, stratum(chunk)[mask]])
+        order = np.lexsort((-priorities, strata))
+        ordered_strata = strata[order]
+        # Rank of each candidate inside its stratum
+        rank = np.arange(len(order)) - np.searchsorted(ordered_strata, ordered_strata)
+        keep = order[rank < quotas[ordered_strata]]
+        kept_index, kept_priority, kept_stratum = index[keep], priorities[keep], strata[keep]
+    return np.sort(kept_index)
+
+def decimate_tracks(file_name, output, budget, strategy='stratified', energy_cut=0., bins=(32, 32),
+                    seed=None, chunk_records=CHUNK_RECORDS):
+    """Writes at most budget segments of a decoded track file above the energy cut.
+
+    energy keeps the most energetic segments, stratified samples evenly across
+    depth (z) and time cells, and reservoir samples uniformly over the file.
+    """
+    tracks = np.load(file_name, mmap_mode='r')
+    valid = lambda chunk: chunk['energy'] >= energy_cut
+    rng = np.random.default_rng(seed)
+    random_priority = lambda chunk: rng.random(len(chunk))
+    whole = lambda chunk: np.zeros(len(chunk), dtype=np.int64)
+
+    if budget <= 0:
+        # No limit: the segments above the cut are copied through chunk by chunk
+        kept = 0
+        with open(output, 'wb') as npyfile:
+            header_length = write_npy_header(npyfile, tracks.dtype, len(tracks))
+            for start in range(0, len(tracks), chunk_records):
+                chunk = tracks[start:start + chunk_records]
+                chunk = chunk[valid(chunk)]
+                npyfile.write(chunk.tobytes())
+                kept += len(chunk)
+            write_npy_header(npyfile, tracks.dtype, kept, header_length)
+        print(f"  {file_name}: kept {kept} of {len(tracks)} segments (no limit)")
+        return output
+
+    if strategy == 'energy':
+        quotas, priority, stratum = np.array([budget]), lambda chunk: chunk['energy'], whole
+    elif strategy == 'reservoir':
+        quotas, priority, stratum = np.array([budget]), random_priority, whole
+    elif strategy == 'stratified':
+        z_range = [np.inf, -np.inf]
+        t_range = [np.inf, -np.inf]
+        for start in range(0, len(tracks), chunk_records):
+            chunk = tracks[start:start + chunk_records]
+            chunk = chunk[valid(chunk)]
+            if len(chunk):
+                z_range = [min(z_range[0], chunk['z'].min()), max(z_range[1], chunk['z'].max())]
+                t_range = [min(t_range[0], chunk['t'].min()), max(t_range[1], chunk['t'].max())]
+        z_edges = np.linspace(*z_range, bins[0] + 1)[1:-1] if np.isfinite(z_range[0]) else np.empty(0)
+        t_edges = np.linspace(*t_range, bins[1] + 1)[1:-1] if np.isfinite(t_range[0]) else np.empty(0)
+        stratum = lambda chunk: np.searchsorted(z_edges, chunk['z']) * bins[1] + np.searchsorted(t_edges, chunk['t'])
+        counts = np.zeros(bins[0] * bins[1], dtype=np.int64)
+        for start in range(0, len(tracks), chunk_records):
+            chunk = tracks[start:start + chunk_records]
+            counts += np.bincount(stratum(chunk[valid(chunk)]), minlength=len(counts))
+        quotas, priority = fill_quotas(counts, budget), random_priority
+    else:
+        print(f"Error: Unknown decimation strategy '{strategy}' (choose from {', '.join(DECIMATION_STRATEGIES)})")
+        sys.exit(1)
+
+    selected = select_top(tracks, quotas, priority, stratum, valid, chunk_records)
+    np.save(output, tracks[selected])
+    print(f"  {file_name}: kept {len(selected)} of {len(tracks)} segments ({strategy})")
+    return output
+
+def decimate_files(file_list: list, budgets: list, strategy='stratified', energy_cuts=(0., 0., 0.), seed=0):
+    """Decimates the em, mu and hd EDresults_*.npy files into EDsample_*.npy files.
+
+    The sampling is seeded so that a given configuration always yields the same sample.
+    """
+    outputs = []
+    for file_name, budget, energy_cut in zip(file_list, budgets, energy_cuts):
+        if not os.path.exists(file_name):
+            print(f"  Warning: Decoded file {file_name} not found. Skipping.")
+            continue
+        output = file_name.replace('EDresults', 'EDsample')
+        outputs.append(decimate_tracks(file_name, output, budget, strategy, energy_cut, seed=seed))
+    return outputs
+
+def ask_decimation():
+    """Asks for the segment budgets, strategy and energy cuts of the animation."""
+    print("\n[1] Maximum number of segments to animate (0 = no limit):")
+    print("  Format: em mu had [DEFAULT: 5000 0 0]")
+    while True:
+        budgets = (input("  Enter budgets: ") or "5000 0 0").split()
+        try:
+            budgets = [int(x) for x in budgets]
+            if len(budgets) == 3:
                 break
-            buffer = buffer2[4:44]
-            properties = struct.unpack("10f", buffer)
-            outfile.write(" ".join(map(str, properties)) + "\\n")
-"""
-    with open('tracks2root.py', 'w') as file:
-        file.write(content)
+            print("  Incorrect format! Enter 3 values separated by spaces.")
+        except ValueError:
+            print("  Invalid values! Use integers (ex: '5000 1000 1000')")
 
-def process_files(file_list: list):
-    """Optimizes files for animation by removing invalid lines."""
+    print("\n[2] Decimation strategy:")
+    print("  energy     = most energetic segments")
+    print("  stratified = even coverage of depth and time")
+    print("  reservoir  = uniform random sample")
+    while True:
+        strategy = input("  Choose [DEFAULT: stratified]: ").lower() or "stratified"
+        if strategy in DECIMATION_STRATEGIES:
+            break
+        print(f"  Invalid option! Choose {', '.join(DECIMATION_STRATEGIES)}.")
+
+    print("\n[3] Minimum energy cuts (in GeV):")
+    print("  Format: em mu had [DEFAULT: 0 0 0]")
+    while True:
+        energy_cuts = (input("  Enter cuts: ") or "0 0 0").split()
+        try:
+            energy_cuts = [float(x) for x in energy_cuts]
+            if len(energy_cuts) == 3:
+                break
+            print("  Incorrect format! Enter 3 values separated by spaces.")
+        except ValueError:
+            print("  Invalid values! Use numbers (ex: '0.001 0.1 0.1')")
+
+    return budgets, strategy, energy_cuts
+
+def chain_files(file_list: list):
+    """Converts decoded track .npy files into polylines_*.npz files for Blender."""
+    outputs = []
     for file_name in file_list:
-        with open(file_name, 'r') as file, open(f'ED{file_name}', 'w') as output_file:
-            for line in file:
-                line = line.strip()
-                words = line.split(' ')
-                if '' not in words and words[2] != words[6]:
-                    output_file.write(' '.join(words) + '\n')
-
-def blender_visu_script():
-    """Generates Blender script for visualization."""
-    content = """import bpy
+        if not os.path.exists(file_name):
+            print(f"  Warning: Decoded file {file_name} not found. Skipping.")
+            continue
+        tracks = np.load(file_name, mmap_mode='r')
+        polylines = build_polylines(tracks)
+        # EDresults_em.npy and EDsample_em.npy both become polylines_em.npz
+        output = 'polylines_' + file_name.rsplit('_', 1)[1].replace('.npy', '.npz')
+        np.savez(output, **polylines)
+        print(f"  {file_name}: {len(tracks)} segments chained into {len(polylines['offsets']) - 1} polylines")
+        outputs.append(output)
+    return outputs
+
+INDEX_AXES = ['x', 'y', 'z', 't']
+INDEX_SAMPLE = 1 << 20
+INDEX_CELL_SEGMENTS = 4096
+
+def index_cells(tracks, edges):
+    """Returns the flat (x, y, z, t) grid cell of the start point of every segment."""
+    cells = np.zeros(len(tracks), dtype=np.int64)
+    for axis, axis_edges in zip(INDEX_AXES, edges):
+        cells = cells * (len(axis_edges) + 1) + np.searchsorted(axis_edges, tracks[axis], side='right')
+    return cells
+
+def index_tracks(file_name, bins=None, chunk_records=CHUNK_RECORDS):
+    """Builds a spatio-temporal index of a decoded track file for windowed queries.
+
+    Segments are grouped by the (x, y, z, t) grid cell of their start point,
+    with cell edges at quantiles of a sample so that cells hold similar numbers
+    of segments. EDresults_em.npy gives EDindex_em.npy with the regrouped
+    segments and EDindex_em.npz with the cell offsets and bounds (covering both
+    endpoints, plus the highest energy), so queries only read matching cells.
+    By default each axis gets enough bins for about INDEX_CELL_SEGMENTS segments
+    per cell, up to 16.
+    """
+    if not os.path.exists(file_name):
+        print(f"  Warning: Decoded file {file_name} not found. Skipping.")
+        return None
+    tracks = np.load(file_name, mmap_mode='r')
+    if bins is None:
+        bins = int(np.clip(round((len(tracks) / INDEX_CELL_SEGMENTS) ** (1 / len(INDEX_AXES))), 1, 16))
+    stride = max(1, len(tracks) // INDEX_SAMPLE)
+    sample = np.array(tracks[::stride])
+    edges = [np.unique(np.quantile(sample[axis], np.linspace(0, 1, bins + 1)[1:-1])) if len(sample) else np.empty(0)
+             for axis in INDEX_AXES]
+    cells = int(np.prod([len(axis_edges) + 1 for axis_edges in edges]))
+
+    # Counting sort: cell sizes first, then every chunk is scattered to its cells
+    counts = np.zeros(cells, dtype=np.int64)
+    for start in range(0, len(tracks), chunk_records):
+        counts += np.bincount(index_cells(tracks[start:start + chunk_records], edges), minlength=cells)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    filled = offsets[:-1].copy()
+    bounds = np.empty((cells, 2 * len(INDEX_AXES) + 1), dtype='f4')
+    bounds[:, 0::2] = np.inf
+    bounds[:, 1::2] = -np.inf
+    root = os.path.splitext(file_name)[0]
+    root = root.replace('EDresults', 'EDindex') if 'EDresults' in root else root + '_index'
+    sorted_file = root + '.npy'
+    output = np.lib.format.open_memmap(sorted_file, mode='w+', dtype=TRACK_DTYPE, shape=(len(tracks),))
+    for start in range(0, len(tracks), chunk_records):
+        chunk = np.array(tracks[start:start + chunk_records])
+        chunk_cells = index_cells(chunk, edges)
+        order = np.argsort(chunk_cells, kind='stable')
+        chunk, chunk_cells = chunk[order], chunk_cells[order]
+        present, first, sizes = np.unique(chunk_cells, return_index=True, return_counts=True)
+        # Position of every segment inside its cell
+        destination = np.repeat(filled[present] - first, sizes) + np.arange(len(chunk))
+        output[destination] = chunk
+        filled[present] += sizes
+        for column, axis in enumerate(INDEX_AXES):
+            low = np.minimum(chunk[axis], chunk[axis + 'end'])
+            high = np.maximum(chunk[axis], chunk[axis + 'end'])
+            bounds[present, 2 * column] = np.minimum(bounds[present, 2 * column], np.minimum.reduceat(low, first))
+            bounds[present, 2 * column + 1] = np.maximum(bounds[present, 2 * column + 1], np.maximum.reduceat(high, first))
+        bounds[present, -1] = np.maximum(bounds[present, -1], np.maximum.reduceat(chunk['energy'], first))
+    output.flush()
+    del output
+
+    index_file = root + '.npz'
+    occupied = counts > 0
+    np.savez(index_file, offsets=offsets[:-1][occupied], counts=counts[occupied], bounds=bounds[occupied],
+             sorted_file=os.path.basename(sorted_file),
+             **{f'edges_{axis}': axis_edges for axis, axis_edges in zip(INDEX_AXES, edges)})
+    print(f"  {file_name}: {len(tracks)} segments indexed in {np.count_nonzero(occupied)} cells")
+    return index_file
+
+def query_tracks(index_file, radius=None, center=(0., 0.), z_range=None, time_window=None, energy=None):
+    """Returns the indexed segments inside a window, reading only the cells that can hold them.
+
+    radius (cm) keeps segments with an endpoint within that horizontal distance
+    of center, z_range (cm) segments with an endpoint in that height range,
+    time_window (s) segments overlapping it and energy (GeV) segments at or
+    above it. Unset criteria do not restrict the selection.
+    """
+    with np.load(index_file) as index:
+        offsets, counts, bounds = index['offsets'], index['counts'], index['bounds']
+        sorted_file = os.path.join(os.path.dirname(index_file), str(index['sorted_file']))
+    xmin, xmax, ymin, ymax, zmin, zmax, tmin, tmax, emax = bounds.T
+    keep = np.ones(len(offsets), dtype=bool)
+    if radius is not None:
+        dx = np.maximum(0, np.maximum(xmin - center[0], center[0] - xmax))
+        dy = np.maximum(0, np.maximum(ymin - center[1], center[1] - ymax))
+        keep &= np.hypot(dx, dy) <= radius
+    if z_range is not None:
+        keep &= (zmax >= z_range[0]) & (zmin <= z_range[1])
+    if time_window is not None:
+        keep &= (tmax >= time_window[0]) & (tmin <= time_window[1])
+    if energy is not None:
+        keep &= emax >= energy
+
+    tracks = np.load(sorted_file, mmap_mode='r')
+    selected = []
+    for start, count in zip(offsets[keep].tolist(), counts[keep].tolist()):
+        chunk = tracks[start:start + count]
+        match = np.ones(len(chunk), dtype=bool)
+        if radius is not None:
+            match &= ((np.hypot(chunk['x'] - center[0], chunk['y'] - center[1]) <= radius) |
+                      (np.hypot(chunk['xend'] - center[0], chunk['yend'] - center[1]) <= radius))
+        if z_range is not None:
+            match &= (((chunk['z'] >= z_range[0]) & (chunk['z'] <= z_range[1])) |
+                      ((chunk['zend'] >= z_range[0]) & (chunk['zend'] <= z_range[1])))
+        if time_window is not None:
+            match &= (np.maximum(chunk['t'], chunk['tend']) >= time_window[0]) & (np.minimum(chunk['t'], chunk['tend']) <= time_window[1])
+        if energy is not None:
+            match &= chunk['energy'] >= energy
+        selected.append(chunk[match])
+    return np.concatenate(selected) if selected else np.empty(0, dtype=TRACK_DTYPE)
+
+# Main particle file DATnnnnnn: Fortran records of 21 sub-blocks of 273 words.
+# Sub-blocks start with a RUNH/EVTH/LONG/EVTE/RUNE marker or hold 39 particles
+# of 7 words (description, px, py, pz, x, y, t) each.
+BLOCK_WORDS = 273
+BLOCKS_PER_RECORD = 21
+PARTICLE_RECORD_DTYPE = np.dtype([('head', 'i4'), ('blocks', 'f4', (BLOCKS_PER_RECORD, BLOCK_WORDS)), ('tail', 'i4')])
+PARTICLE_FIELDS = ['description', 'px', 'py', 'pz', 'x', 'y', 't']
+PARTICLE_DTYPE = np.dtype([(name, 'f4') for name in PARTICLE_FIELDS])
+BLOCK_MARKERS = [b'RUNH', b'EVTH', b'LONG', b'EVTE', b'RUNE']
+# Particle groups by CORSIKA particle code, with rest masses in GeV
+PARTICLE_GROUPS = {'gamma': [1], 'electrons': [2, 3], 'muons': [5, 6], 'hadrons': [7, 8, 9, 10, 11, 12, 13, 14, 15, 16]}
+PARTICLE_MASSES = {1: 0., 2: 0.000511, 3: 0.000511, 5: 0.105658, 6: 0.105658, 7: 0.134977, 8: 0.139570, 9: 0.139570,
+                   10: 0.497611, 11: 0.493677, 12: 0.493677, 13: 0.939565, 14: 0.938272, 15: 0.938272, 16: 0.497611}
+
+def map_particles(datafile):
+    """Memory-maps a CORSIKA particle file as an array of Fortran records."""
+    size = os.path.getsize(datafile)
+    if size == 0 or size % PARTICLE_RECORD_DTYPE.itemsize:
+        print(f"Error: {datafile} is not a sequence of {PARTICLE_RECORD_DTYPE.itemsize}-byte particle records "
+              "(thinned files are not supported)")
+        sys.exit(1)
+    records = np.memmap(datafile, dtype=PARTICLE_RECORD_DTYPE, mode='r')
+    if records[0]['head'] != PARTICLE_RECORD_DTYPE.itemsize - 8:
+        print(f"Error: Unexpected record length marker in {datafile}")
+        sys.exit(1)
+    return records
+
+def block_kinds(records, start=0, stop=None):
+    """Returns the marker of every sub-block of records[start:stop] (b'' for particle blocks)."""
+    heads = np.ascontiguousarray(records['blocks'][start:stop, :, 0]).view('S4')
+    return np.where(np.isin(heads, BLOCK_MARKERS), heads, b'')
+
+def iter_showers(datafile, chunk_records=4096):
+    """Yields (event header, particles) for every shower of a particle file.
+
+    The event header is the 273-word EVTH sub-block and particles is a list of
+    structured arrays viewing the file directly, one per run of consecutive
+    particle sub-blocks inside a record; nothing is copied. Empty particle
+    slots (zero description) are left in the views.
+    """
+    records = map_particles(datafile)
+    blocks = records['blocks']
+    header = None
+    particles = []
+    for start in range(0, len(records), chunk_records):
+        kinds = block_kinds(records, start, start + chunk_records)
+        for row, record in enumerate(range(start, start + len(kinds))):
+            first = None
+            for block, kind in enumerate(kinds[row].tolist() + [b'END']):
+                if kind == b'' and header is not None:
+                    first = block if first is None else first
+                    continue
+                if first is not None:
+                    particles.append(blocks[record, first:block].reshape(-1).view(PARTICLE_DTYPE))
+                    first = None
+                if kind == b'EVTH':
+                    header = blocks[record, block]
+                    particles = []
+                elif kind == b'EVTE' and header is not None:
+                    yield header, particles
+                    header = None
+
+def particle_histograms(datafile, r_edges=None, e_edges=None, level=1, chunk_records=4096):
+    """Histograms lateral distance and energy of the particles reaching an observation level.
+
+    Returns, for every particle group, the counts per radial bin, the mean
+    lateral density per shower (particles/m^2) and the counts per energy bin.
+    Records are processed in chunks, so memory stays bounded for any file size.
+    """
+    r_edges = np.logspace(2, 6, 41) if r_edges is None else np.asarray(r_edges)
+    e_edges = np.logspace(-4, 6, 51) if e_edges is None else np.asarray(e_edges)
+    masses = np.zeros(max(PARTICLE_MASSES) + 1)
+    for code, mass in PARTICLE_MASSES.items():
+        masses[code] = mass
+    lateral = {group: np.zeros(len(r_edges) - 1, dtype=np.int64) for group in PARTICLE_GROUPS}
+    spectrum = {group: np.zeros(len(e_edges) - 1, dtype=np.int64) for group in PARTICLE_GROUPS}
+
+    records = map_particles(datafile)
+    showers = 0
+    inside = False
+    for start in range(0, len(records), chunk_records):
+        kinds = block_kinds(records, start, start + chunk_records).reshape(-1)
+        # Particle blocks between an EVTH and its EVTE
+        opened = np.cumsum(kinds == b'EVTH') + inside
+        closed = np.cumsum(kinds == b'EVTE')
+        in_shower = (opened - closed > 0) & (kinds == b'')
+        inside = bool(opened[-1] - closed[-1] > 0)
+        showers += int(np.count_nonzero(kinds == b'EVTE'))
+
+        chunk = records['blocks'][start:start + chunk_records].reshape(-1, BLOCK_WORDS)[in_shower]
+        particles = np.ascontiguousarray(chunk).reshape(-1).view(PARTICLE_DTYPE)
+        description = particles['description'].astype(np.int64)
+        code = description // 1000
+        particles = particles[(code > 0) & (description % 10 == level)]
+        code = code[(code > 0) & (description % 10 == level)]
+        r = np.hypot(particles['x'], particles['y'])
+        momentum2 = particles['px'].astype('f8')**2 + particles['py'].astype('f8')**2 + particles['pz'].astype('f8')**2
+        energy = np.sqrt(momentum2 + np.where(code < len(masses), masses[np.minimum(code, len(masses) - 1)], 0.)**2)
+        for group, codes in PARTICLE_GROUPS.items():
+            selected = np.isin(code, codes)
+            lateral[group] += np.histogram(r[selected], r_edges)[0]
+            spectrum[group] += np.histogram(energy[selected], e_edges)[0]
+
+    # Annulus areas in m^2
+    areas = np.pi * np.diff(r_edges**2) / 1e4
+    return {
+        'showers': showers,
+        'r_edges': r_edges,
+        'e_edges': e_edges,
+        'lateral_counts': lateral,
+        'lateral_density': {group: counts / areas / max(showers, 1) for group, counts in lateral.items()},
+        'energy_counts': spectrum
+    }
+
+def save_particle_histograms(datafile, output=None):
+    """Writes the particle histograms of a particle file to an .npz file and prints totals."""
+    histograms = particle_histograms(datafile)
+    output = output or f"{datafile}.hist.npz"
+    arrays = {'showers': histograms['showers'], 'r_edges': histograms['r_edges'], 'e_edges': histograms['e_edges']}
+    for key in ['lateral_counts', 'lateral_density', 'energy_counts']:
+        for group, values in histograms[key].items():
+            arrays[f"{key}_{group}"] = values
+    np.savez(output, **arrays)
+    print(f"  {datafile}: {histograms['showers']} showers")
+    for group, counts in histograms['lateral_counts'].items():
+        print(f"    {group:<10} {counts.sum():>12} particles at the observation level")
+    print(f"  Generated: {output}")
+    return output
+
+def cache_histograms(datafile):
+    """Writes the histograms of a particle file once, warning and returning None instead of failing on a damaged one."""
+    histograms = f"{datafile}.hist.npz"
+    if os.path.exists(histograms):
+        return histograms
+    if not os.path.exists(datafile) or not os.path.getsize(datafile):
+        return None
+    try:
+        return save_particle_histograms(datafile, histograms)
+    except (SystemExit, Exception) as error:
+        print(f"  Warning: Histograms of {datafile} could not be computed ({error})")
+        return None
+
+# Longitudinal profile file DATnnnnnn.long written with LONGI T
+LONG_PARTICLE_COLUMNS = ['gammas', 'positrons', 'electrons', 'mu+', 'mu-', 'hadrons', 'charged', 'nuclei', 'cherenkov']
+LONG_DEPOSIT_COLUMNS = ['gamma', 'em_ioniz', 'em_cut', 'mu_ioniz', 'mu_cut', 'hadr_ioniz', 'hadr_cut', 'neutrino', 'sum']
+LONG_TABLE_PATTERN = re.compile(r'LONGITUDINAL (DISTRIBUTION|ENERGY DEPOSIT) IN\s+(\d+)')
+# Fixed-format numbers may be glued together, e.g. 1.00000E+00-2.00000E+00
+NUMBER_PATTERN = re.compile(r'[-+]?(?:\d+\.\d*|\.\d+)(?:[Ee][-+]?\d+)?')
+
+def parse_long(path) -> dict:
+    """Parses the particle and energy-deposit tables and Gaisser-Hillas fits of a .long file.
+
+    Returns arrays with one row per shower: depth (showers, steps), particles
+    and deposit (showers, steps, columns), gh_params (showers, 6) and gh_chi2.
+    Showers without a fit get NaN parameters.
+    """
+    with open(path, 'r') as file:
+        lines = file.read().splitlines()
+    tables = {'DISTRIBUTION': [], 'ENERGY DEPOSIT': []}
+    fits = []
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        match = LONG_TABLE_PATTERN.search(line)
+        if match:
+            steps = int(match.group(2))
+            # Title and column header lines come before the values
+            block = ' '.join(lines[index + 2:index + 2 + steps])
+            tables[match.group(1)].append(np.array(NUMBER_PATTERN.findall(block), dtype='f8').reshape(steps, -1))
+            if match.group(1) == 'DISTRIBUTION':
+                fits.append(np.full(7, np.nan))
+            index += 2 + steps
+            continue
+        if line.strip().startswith('PARAMETERS') and fits:
+            fits[-1][:6] = np.array(NUMBER_PATTERN.findall(line.split('=', 1)[1]), dtype='f8')[:6]
+        elif line.strip().startswith('CHI**2/DOF') and fits:
+            fits[-1][6] = float(NUMBER_PATTERN.findall(line.split('=', 1)[1])[0])
+        index += 1
+
+    if not fits:
+        tables['DISTRIBUTION'] = np.empty((0, 0, len(LONG_PARTICLE_COLUMNS) + 1))
+    distribution = np.array(tables['DISTRIBUTION'], dtype='f4')
+    deposit = np.array(tables['ENERGY DEPOSIT'], dtype='f4')
+    fits = np.array(fits, dtype='f8').reshape(-1, 7)
+    return {
+        'depth': distribution[:, :, 0],
+        'particles': distribution[:, :, 1:],
+        'deposit': deposit[:, :, 1:] if deposit.size else np.empty((len(fits), 0, len(LONG_DEPOSIT_COLUMNS)), dtype='f4'),
+        'gh_params': fits[:, :6].astype('f4'),
+        'gh_chi2': fits[:, 6].astype('f4')
+    }
+
+def load_long(path) -> dict:
+    """Returns the parsed .long file, reading it from (or writing it to) a .long.npz cache next to it."""
+    cache = f"{path}.npz"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        with np.load(cache) as arrays:
+            return dict(arrays)
+    profiles = parse_long(path)
+    np.savez(cache, **profiles)
+    return profiles
+
+def cache_long(path):
+    """Loads (and caches) a .long file, warning and returning None instead of failing on a damaged one."""
+    try:
+        return load_long(path)
+    except (ValueError, IndexError, OSError) as error:
+        print(f"  Warning: {path} could not be parsed ({error})")
+        return None
+
+def aggregate_long(pattern="data_run_*/DAT*.long", column='charged') -> dict:
+    """Computes mean and RMS longitudinal profiles and Xmax statistics over all showers of many runs.
+
+    Profiles of runs with different depth grids are aligned on the union of
+    their depths and missing steps are ignored.
+    """
+    # Runs without showers (failed or killed) are left out together with their paths
+    loaded = [(path, cache_long(path)) for path in sorted(glob.glob(pattern))]
+    loaded = [(path, profiles) for path, profiles in loaded if profiles is not None and len(profiles['depth'])]
+    paths = [path for path, _ in loaded]
+    runs = [profiles for _, profiles in loaded]
+    if not runs:
+        print(f"No longitudinal profiles found in {pattern}")
+        return {}
+    position = LONG_PARTICLE_COLUMNS.index(column)
+    depth = np.unique(np.concatenate([profiles['depth'].reshape(-1) for profiles in runs]))
+    showers = sum(len(profiles['depth']) for profiles in runs)
+    profile = np.full((showers, len(depth)), np.nan, dtype='f4')
+    row = 0
+    for profiles in runs:
+        count = len(profiles['depth'])
+        columns = np.searchsorted(depth, profiles['depth'])
+        profile[np.arange(row, row + count)[:, None], columns] = profiles['particles'][:, :, position]
+        row += count
+
+    xmax = np.concatenate([profiles['gh_params'][:, 2] for profiles in runs])
+    run_of_shower = np.repeat(np.arange(len(runs)), [len(profiles['depth']) for profiles in runs])
+    with np.errstate(invalid='ignore'):
+        run_xmax = np.bincount(run_of_shower, np.nan_to_num(xmax)) / np.bincount(run_of_shower, np.isfinite(xmax))
+    return {
+        'depth': depth,
+        'mean': np.nanmean(profile, axis=0),
+        'rms': np.nanstd(profile, axis=0),
+        'xmax_mean': np.nanmean(xmax),
+        'xmax_rms': np.nanstd(xmax),
+        'showers': showers,
+        'runs': np.array([os.path.dirname(path) or path for path in paths]),
+        'run_xmax_mean': run_xmax
+    }
+
+def save_long_summary(pattern="data_run_*/DAT*.long", output="long_profiles.npz"):
+    """Aggregates the .long files matching pattern, prints Xmax per run and saves the profiles."""
+    summary = aggregate_long(pattern)
+    if not summary:
+        return None
+    print(f"\n{'run':<24} {'<Xmax> g/cm2':>13}")
+    for run, xmax in zip(summary['runs'], summary['run_xmax_mean']):
+        print(f"{run:<24} {xmax:>13.1f}")
+    print(f"\n{summary['showers']} showers: <Xmax> = {summary['xmax_mean']:.1f} g/cm2, RMS = {summary['xmax_rms']:.1f} g/cm2")
+    np.savez(output, **summary)
+    print(f"  Generated: {output}")
+    return output
+
+TIME_MAPPINGS = ['linear', 'log', 'quantile']
+LATE_TRACKS = ['clip', 'fold']
+# Start and end frames are rounded into this many buckets when batching
+FRAME_BUCKETS = 24
+
+def blender_visu_script(batched=True, frames=None, fps=30, time_mapping='linear', late_tracks='clip', late_quantile=0.99,
+                        frame_buckets=FRAME_BUCKETS):
+    """Generates Blender script for visualization.
+
+    When batched, the start and end frames of the polylines are rounded into
+    frame_buckets buckets, and the polylines of each particle class in the
+    same pair of buckets become the splines of a single curve object. A class
+    therefore has at most frame_buckets * (frame_buckets + 1) / 2 objects.
+    Without frames, one frame lasts a microsecond of shower time. Otherwise
+    segment times are remapped (linearly, logarithmically or by quantiles) onto
+    that many frames. Times beyond the late_quantile of all times are clipped
+    to the last frame, or folded logarithmically into the last tenth of them.
+    """
+    content = f"""import bpy
 import time
 from math import cos
 import os
+import json
+import numpy as np
 
-file_names = ['EDresults_em_5k', 'EDresults_mu', 'EDresults_hd']
-limit = -1
+file_names = ['polylines_em.npz', 'polylines_mu.npz', 'polylines_hd.npz']
+batched = {batched}
+frame_budget = {frames or 0}
+fps = {fps}
+time_mapping = '{time_mapping}'
+late_tracks = '{late_tracks}'
+late_quantile = {late_quantile}
+frame_buckets = {frame_buckets}
+""" + """
+def frame_mapping(times):
+    # Maps CORSIKA times (s) to frame numbers
+    if not frame_budget:
+        return lambda t: (t*1000000).astype(int)
+    start, last = times.min(), times.max()
+    end = max(np.quantile(times, late_quantile), np.nextafter(start, np.inf))
+    tail = max(1, frame_budget // 10) if late_tracks == 'fold' and last > end else 0
+    main = frame_budget - tail
+    if time_mapping == 'quantile':
+        knots = np.quantile(times[times <= end], np.linspace(0, 1, main))
+        body = lambda t: np.interp(t, knots, np.linspace(0, 1, main))
+    elif time_mapping == 'log':
+        scale = (end - start) / 1000
+        body = lambda t: np.log1p(np.maximum(t - start, 0) / scale) / np.log1p((end - start) / scale)
+    else:
+        body = lambda t: (t - start) / (end - start)
+    def mapping(t):
+        position = 1 + np.clip(body(t), 0, 1) * (main - 1)
+        if tail:
+            late = t > end
+            position[late] = main + tail * np.log1p((t[late] - end) / (end - start)) / np.log1p((last - end) / (end - start))
+        return np.rint(position).astype(int)
+    return mapping
 
 def make_curve(points, loop2):
     curveData = bpy.data.curves.new(f'myCurve{loop2}', type='CURVE')
@@ -285,6 +1609,22 @@ def make_curve(points, loop2):
     scn = bpy.context.scene
     scn.collection.objects.link(curveOB)
     bpy.ops.object.shade_smooth()
+
+def make_batch(coords, spans, loop, loop2):
+    # All the polylines of a batch are splines of one curve, read in bulk from coords (x, y, z, 1)
+    curveData = bpy.data.curves.new(f'myCurve{loop2}', type='CURVE')
+    curveData.dimensions = '3D'
+    curveData.resolution_u = 4
+    curveData.bevel_resolution = 6
+    curveData.bevel_depth = 0.001667
+    for start, end in spans:
+        polyline = curveData.splines.new('POLY')
+        polyline.points.add(end - start - 1)
+        polyline.points.foreach_set('co', coords[start:end].ravel())
+        polyline.use_smooth = True
+    curveData.materials.append(bpy.data.materials[f'base{loop}'])
+    curveOB = bpy.data.objects.new(f'myCurve{loop2}', curveData)
+    bpy.context.scene.collection.objects.link(curveOB)
     
 def remove_materials_objects():
     for material in bpy.data.materials:
@@ -330,122 +1670,56 @@ def animate(t_i, t_f, loop2):
     curve.animation_data.action.fcurves[0].keyframe_points[0].interpolation = 'LINEAR'
     curve.bevel_factor_mapping_end = 'SPLINE'
     
-def process_curve_data(data):
-    x = []
-    y = []
-    xend = []
-    yend = []
-    new_data = []
-    for line in data:
-        line = line.replace('\\n', '')
-        l = line.split(' ')
-        new_data.append(l)
-        x.append(float(l[2])/1000000)
-        xend.append(float(l[6])/1000000)
-        y.append(float(l[3])/1000000)
-        yend.append(float(l[7])/1000000)
-    xif = inif(x, xend)
-    yif = inif(y, yend)
-    mesmax = mesmalinha(xif)
-    mesmay = mesmalinha(yif)
-    mesma = (mesmax, mesmay)
-    all_curves_x = []
-    all_curves_y = []
-    for loop, data in enumerate(mesma):
-        for line in data:
-            indexes = []
-            for j in range(0, len(line)):
-                if loop == 0:
-                    indexes.append(x.index(line[j][0]))
-                else:
-                    indexes.append(y.index(line[j][0]))
-            data_to_save = []
-            for g in range(0, len(line)):
-                data_to_save.append(new_data[indexes[g]])
-            if loop == 0:
-                all_curves_x.append(data_to_save)
-            else:
-                all_curves_y.append(data_to_save)
-    if len(all_curves_x) < len(all_curves_y):
-        maior_curva = all_curves_y.copy()
-        menor_curva = all_curves_x.copy()
-    else:
-        maior_curva = all_curves_x.copy()
-        menor_curva = all_curves_y.copy()
-    all_curves = []
-    for data in maior_curva:
-        if data in menor_curva:
-            all_curves.append(data)
-    return all_curves
-    
-def mesmalinha(initial_final):
-    lines = []
-    initials = [f[0] for f in initial_final]
-    finals = [f[1] for f in initial_final]
-    k = 0
-    for i, f in initial_final:
-        if f in initials and i not in finals:
-            lines.append([[i, f]])
-            continue
-        count_bif = 0
-        for curve in lines:
-            for xi, xf in curve:
-                if i == xi or i == xf:
-                    count_bif += 1
-                if count_bif > 1:
-                    lines.append([[i, f]])
-                    break
-            if count_bif > 1:
-                break
-        if count_bif > 1:
-            continue
-        loop = 0
-        for curve in lines:
-            for xi, xf in curve:
-                if i == xf:
-                    lines[loop].append([i, f])
-            loop += 1
-    return lines
-    
-def inif(li, lf):
-    tu = []
-    for i in range(0, len(li)):
-        tu.append([li[i], lf[i]])
-    return tu
-    
 # Main execution
 start_time = time.time()
 remove_materials_objects()
 loop2 = 0
 last_frame = 0
+# Every class shares one time mapping
+times = [np.concatenate([polylines['t'], polylines['tend']]) for polylines in
+         (np.load(os.path.join('data', file_name)) for file_name in file_names if os.path.exists(os.path.join('data', file_name)))]
+times = np.concatenate(times) if times else np.empty(0)
+to_frames = frame_mapping(times if len(times) else np.zeros(1))
 for loop, file_name in enumerate(file_names):
     file_path = os.path.join('data', file_name)
     if not os.path.exists(file_path):
         print(f'File {file_path} not found. Skipping.')
         continue
-    with open(file_path, 'r') as file:
-        tabraw = file.readlines(limit)
-    curve_data = process_curve_data(tabraw)
+    polylines = np.load(file_path)
+    points = polylines['points']/1000000
+    offsets = polylines['offsets']
+    initial_times = to_frames(polylines['t'])
+    final_times = to_frames(polylines['tend'])
     create_material(loop)
-    for curve in curve_data:
+    if batched:
+        frames = np.stack([initial_times, final_times])
+        frames = np.stack([frames.min(axis=0), frames.max(axis=0)])
+        frames[1] += frames[0] == frames[1]
+        coords = np.ones((len(points), 4), dtype=np.float32)
+        coords[:, :3] = points
+        # One object per pair of start and end buckets, growing from the earliest start to the latest end
+        first_frame = frames[0].min() if len(frames[0]) else 0
+        width = max(1, -(-(frames.max(initial=0) + 1 - first_frame) // frame_buckets))
+        pairs, batch = np.unique((frames.T - first_frame) // width, axis=0, return_inverse=True)
+        batch = batch.ravel()
+        order = np.argsort(batch, kind='stable')
+        bounds = np.searchsorted(batch[order], np.arange(len(pairs) + 1))
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            loop2 += 1
+            curves = order[first:last]
+            make_batch(coords, zip(offsets[curves], offsets[curves + 1]), loop, loop2)
+            animate(int(frames[0, curves].min()), int(frames[1, curves].max()), loop2)
+        if len(pairs):
+            last_frame = max(last_frame, int(frames[1].max()))
+        print(f'{file_name}: {len(offsets) - 1} polylines in {len(pairs)} objects')
+        continue
+    for curve in range(len(offsets) - 1):
         loop2 += 1
-        points = []
-        for count, l in enumerate(curve):
-            x = float(l[2])/1000000
-            y = float(l[3])/1000000
-            z = float(l[4])/1000000
-            tini = float(l[5])*1000000
-            xend = float(l[6])/1000000
-            yend = float(l[7])/1000000
-            zend = float(l[8])/1000000
-            tend = float(l[9])*1000000
-            points.append((x, y, z))
-            if count == 0:
-                initial_time = int(tini)
-            final_time = int(tend)
-            if initial_time == final_time:
-                final_time = initial_time + 1
-        make_curve(points, loop2)
+        initial_time = int(initial_times[curve])
+        final_time = int(final_times[curve])
+        if initial_time == final_time:
+            final_time = initial_time + 1
+        make_curve(points[offsets[curve]:offsets[curve + 1]], loop2)
         insert_material(loop, loop2)
         animate(initial_time, final_time, loop2)
         if final_time > last_frame:
@@ -458,7 +1732,8 @@ bpy.context.scene.camera = bpy.data.objects['Camera']
 bpy.context.scene.render.resolution_x = 1080
 bpy.context.scene.render.resolution_y = 1920
 bpy.data.worlds['World'].node_tree.nodes['Background'].inputs[0].default_value = (0., 0., 0., 1)
-bpy.context.scene.frame_end = last_frame + 10
+bpy.context.scene.frame_end = frame_budget if frame_budget else last_frame + 10
+bpy.context.scene.render.fps = fps
 bpy.context.scene.eevee.use_bloom = True
 bpy.context.scene.eevee.use_gtao = True
 bpy.context.scene.eevee.use_ssr = True
@@ -466,14 +1741,726 @@ bpy.context.scene.eevee.use_motion_blur = True
 
 # Save the Blender file
 bpy.ops.wm.save_mainfile(filepath=os.path.join(os.getcwd(), 'output.blend'))
+
+# Frame range for the render workers
+with open(os.path.join(os.getcwd(), 'frame_range.json'), 'w') as file:
+    json.dump({'frame_start': bpy.context.scene.frame_start, 'frame_end': bpy.context.scene.frame_end}, file)
 """
     with open('blender_script.py', 'w') as file:
         file.write(content)
 
+def frame_ranges(frames: list, chunks: int) -> list:
+    """Splits sorted frame numbers into contiguous (start, end) ranges, about chunks of them."""
+    size = max(1, -(-len(frames) // max(1, chunks)))
+    ranges = []
+    for frame in frames:
+        if ranges and frame == ranges[-1][1] + 1 and ranges[-1][1] - ranges[-1][0] + 1 < size:
+            ranges[-1][1] = frame
+        else:
+            ranges.append([frame, frame])
+    return [tuple(frame_range) for frame_range in ranges]
+
+def render_range(blend_file: str, start: int, end: int, threads: int):
+    """Renders one frame range of a saved scene in a background Blender process."""
+    command = ["blender", "-b", blend_file, "-E", "CYCLES", "-o", "img###.png",
+               "-t", str(threads), "-s", str(start), "-e", str(end), "-a"]
+    result = subprocess.run(command, text=True, capture_output=True)
+    if result.returncode:
+        print(f"  Warning: Blender failed on frames {start}-{end} (status {result.returncode}):")
+        print("\n".join(result.stderr.splitlines()[-10:]))
+    return start, end
+
+def frame_file(frame: int) -> str:
+    """Returns the image Blender writes for a frame with the img###.png output pattern."""
+    return f"img{frame:03d}.png"
+
+def read_frames(frame_range="frame_range.json") -> list:
+    """Returns the frame numbers of the animation saved by the Blender script."""
+    with open(frame_range, 'r') as file:
+        frame_range = json.load(file)
+    return list(range(frame_range['frame_start'], frame_range['frame_end'] + 1))
+
+def render_frames(frames: list, blend_file="output.blend", workers=1, retries=2, consumed=(), cpus=None):
+    """Renders a saved scene with several Blender processes working on separate frame ranges.
+
+    The workers share cpus threads (by default every CPU). Frames still
+    missing once every range has finished are queued again, up to retries
+    times, before giving up. Frames in consumed were already picked up (and
+    removed) by the encoder and count as rendered.
+    """
+    threads = max(1, (cpus or os.cpu_count() or 1) // workers)
+    missing = frames
+    for attempt in range(retries + 1):
+        # A few ranges per worker keep every process busy until the end
+        ranges = frame_ranges(missing, workers * 4)
+        print(f"  Rendering {len(missing)} frames in {len(ranges)} ranges on {workers} Blender processes ({threads} threads each)...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda frame_range: render_range(blend_file, *frame_range, threads), ranges))
+        missing = [frame for frame in frames if frame not in consumed and not os.path.exists(frame_file(frame))]
+        if not missing:
+            return frames
+        print(f"  Warning: {len(missing)} frames missing after attempt {attempt + 1}")
+    print(f"Error: Frames could not be rendered: {', '.join(map(str, missing[:20]))}{' ...' if len(missing) > 20 else ''}")
+    sys.exit(1)
+
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+def png_complete(path: str) -> bool:
+    """Tells whether a PNG file has been completely written (ends with its IEND chunk)."""
+    try:
+        with open(path, 'rb') as file:
+            file.seek(-len(PNG_END), os.SEEK_END)
+            return file.read() == PNG_END
+    except OSError:
+        return False
+
+def encode_frames(frames: list, finished, output="output.mp4", fps=30, consumed=None):
+    """Feeds frames to ffmpeg in order as soon as each one is written, deleting it afterwards.
+
+    finished tells when no more frames will be produced; encoding stops with an
+    error if a frame is still missing by then.
+    """
+    consumed = set() if consumed is None else consumed
+    with open("ffmpeg.log", "w") as log:
+        encoder = subprocess.Popen(["ffmpeg", "-f", "image2pipe", "-r", str(fps), "-i", "-", output, "-y"],
+                                   stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            for frame in frames:
+                path = frame_file(frame)
+                while not png_complete(path):
+                    if finished() and not png_complete(path):
+                        print(f"Error: Frame {frame} was never rendered, stopping the encoder")
+                        return False
+                    time.sleep(0.2)
+                with open(path, 'rb') as file:
+                    shutil.copyfileobj(file, encoder.stdin)
+                consumed.add(frame)
+                os.remove(path)
+        except BrokenPipeError:
+            pass
+        finally:
+            # Closing flushes the pipe, which fails too once ffmpeg has exited
+            with contextlib.suppress(BrokenPipeError):
+                encoder.stdin.close()
+            returncode = encoder.wait()
+    if returncode:
+        print(f"Error: ffmpeg failed (status {returncode}), see ffmpeg.log")
+        return False
+    os.remove("ffmpeg.log")
+    return True
+
+def render_animation(workers=1, output="output.mp4", fps=30, cpus=None):
+    """Builds the Blender scene, then renders and encodes its frames concurrently on cpus threads."""
+    execute_command("blender -b -P blender_script.py")
+    frames = read_frames()
+    consumed = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        render = pool.submit(render_frames, frames, workers=workers, consumed=consumed, cpus=cpus)
+        encoded = encode_frames(frames, render.done, output, fps, consumed)
+        # Re-raises the exit of a failed render
+        render.result()
+    if not encoded:
+        sys.exit(1)
+
+CORSIKA_BINARY = "./corsika78010Linux_EPOS_urqmd"
+
+def load_sweep_spec(path):
+    """Reads a JSON (or, with PyYAML installed, YAML) parameter sweep specification."""
+    with open(path, 'r') as file:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                print("Error: PyYAML is required to read YAML sweep files (pip install pyyaml)")
+                sys.exit(1)
+            return yaml.safe_load(file)
+        return json.load(file)
+
+def expand_sweep(spec: dict) -> list:
+    """Expands a sweep specification into one card parameter set per run.
+
+    Every combination of the values listed under "sweep" is combined with the
+    fixed "base" parameters and repeated "repeat" times. Runs get consecutive
+    RUNNR values from "first_run" (or a RUNNR in "base") and their own pair of
+    SEED sequences, unless the sweep lists RUNNR or SEED values itself.
+    """
+    names = {name for name, _, _ in CARD_FIELDS}
+    base = spec.get('base', {})
+    sweep = spec.get('sweep', {})
+    unknown = (set(base) | set(sweep)) - names
+    if unknown:
+        print(f"Error: Unknown card fields in sweep specification: {', '.join(sorted(unknown))}")
+        sys.exit(1)
+
+    # A fixed RUNNR in base numbers the runs from there on
+    first_run = int(spec.get('first_run', base.get('RUNNR', 1)))
+    first_seed = int(spec.get('first_seed', 1))
+    combinations = [dict(zip(sweep, values)) for values in itertools.product(*sweep.values())]
+    runs = []
+    for combination in combinations:
+        for _ in range(int(spec.get('repeat', 1))):
+            index = len(runs)
+            params = dict(base, **combination)
+            # Run numbers and seeds given in the sweep are kept, the missing ones generated
+            params['RUNNR'] = int(combination.get('RUNNR', first_run + index))
+            params.setdefault('SEED1', f"{first_seed + 2 * index}    0   0")
+            params.setdefault('SEED2', f"{first_seed + 2 * index + 1}    0   0")
+            runs.append(params)
+    numbers = [params['RUNNR'] for params in runs]
+    if len(set(numbers)) < len(numbers):
+        print("Error: Sweep runs share RUNNR values, list distinct ones or leave RUNNR out of the sweep")
+        sys.exit(1)
+    seeds = [(params['SEED1'].split(), params['SEED2'].split()) for params in runs]
+    if any(seeds.count(pair) > 1 for pair in seeds):
+        print("Error: Sweep runs share SEED1 and SEED2 values, list distinct ones or leave them out")
+        sys.exit(1)
+    if runs and max(numbers) > 999999:
+        print("Error: Sweep run numbers exceed RUNNR 999999")
+        sys.exit(1)
+    return runs
+
+# CORSIKA prints this once every shower has been simulated
+SHOWER_END_PATTERN = re.compile(r'END OF (SHOWER|EVENT)')
+LOG_MAX_BYTES = 50 * 2**20
+LOG_BACKUPS = 3
+LOG_TAIL_LINES = 40
+
+def format_seconds(seconds: float) -> str:
+    """Formats a duration as h:mm:ss."""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def rotate_log(log_file: str, backups=LOG_BACKUPS):
+    """Shifts log_file to log_file.1 (and older copies one further), dropping the oldest."""
+    for index in range(backups - 1, 0, -1):
+        if os.path.exists(f"{log_file}.{index}"):
+            os.replace(f"{log_file}.{index}", f"{log_file}.{index + 1}")
+    os.replace(log_file, f"{log_file}.1")
+
+def run_simulation(card="user_card", log_file="corsika.log", binary=CORSIKA_BINARY, cwd=None, progress=True, check=True) -> int:
+    """Runs CORSIKA, streaming its output to a rotating log file and reporting shower progress.
+
+    Only the last LOG_TAIL_LINES lines are kept in memory and shown on failure.
+    """
+    nshow = None
+    with open(card, 'r') as file:
+        for line in file:
+            if line.startswith("NSHOW"):
+                nshow = int(line.split()[1])
+
+    tail = collections.deque(maxlen=LOG_TAIL_LINES)
+    showers = 0
+    written = 0
+    start = time.time()
+    log = open(log_file, 'w')
+    try:
+        with open(card, 'r') as stdin:
+            process = subprocess.Popen([binary], cwd=cwd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       text=True, errors='replace')
+            for line in process.stdout:
+                log.write(line)
+                written += len(line)
+                if written >= LOG_MAX_BYTES:
+                    log.close()
+                    rotate_log(log_file)
+                    log = open(log_file, 'w')
+                    written = 0
+                tail.append(line.rstrip('\n'))
+                if SHOWER_END_PATTERN.search(line):
+                    showers += 1
+                    if progress:
+                        elapsed = time.time() - start
+                        remaining = f", about {format_seconds(elapsed / showers * (nshow - showers))} remaining" if nshow else ""
+                        print(f"  Shower {showers} of {nshow or '?'} finished after {format_seconds(elapsed)}{remaining}")
+            returncode = process.wait()
+    finally:
+        log.close()
+
+    if returncode:
+        print(f"Error executing CORSIKA (status {returncode}), last lines of {log_file}:")
+        print("\n".join(tail))
+        if check:
+            sys.exit(1)
+    return returncode
+
+def prepare_scratch(scratch: str, corsika_dir: str, params: dict, epos_dir: str) -> str:
+    """Creates a scratch directory linking the CORSIKA files, with the card of params as user_card."""
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(scratch)
+    # CORSIKA looks for its tables in the working directory
+    for name in os.listdir(corsika_dir):
+        source = os.path.join(corsika_dir, name)
+        if os.path.isfile(source) and not name.startswith(('DAT', 'user_card')):
+            os.symlink(source, os.path.join(scratch, name))
+    with open(os.path.join(scratch, "user_card"), "w") as file:
+        file.write(card_content(params, epos_dir))
+    return scratch
+
+def run_card(params: dict, binary: str, scratch_root: str, corsika_dir: str, epos_dir: str):
+    """Runs CORSIKA for one card in its own scratch directory and collects the outputs."""
+    run_number_str = f"{int(params['RUNNR']):06d}"
+    scratch = prepare_scratch(os.path.join(scratch_root, f"run_{run_number_str}"), corsika_dir, params, epos_dir)
+
+    output_dir = os.path.join(corsika_dir, f"data_run_{run_number_str}")
+    os.makedirs(output_dir, exist_ok=True)
+    report = new_report(os.path.join(output_dir, REPORT_FILE), run=int(params['RUNNR']))
+    with stage_timer(report, "simulation", [os.path.join(scratch, "user_card")], [os.path.join(scratch, "DAT*")]) as record:
+        returncode = run_simulation(os.path.join(scratch, "user_card"), os.path.join(scratch, "corsika.log"), binary,
+                                    cwd=scratch, progress=False, check=False)
+        if returncode:
+            record['status'] = 'failed'
+
+    for name in os.listdir(scratch):
+        path = os.path.join(scratch, name)
+        if not os.path.islink(path):
+            shutil.move(path, os.path.join(output_dir, name))
+    shutil.rmtree(scratch)
+    long_file = os.path.join(output_dir, f"DAT{run_number_str}.long")
+    datafile = os.path.join(output_dir, f"DAT{run_number_str}")
+    if not returncode:
+        # Summary caches are written here so that cataloging the run stays cheap
+        with stage_timer(report, "summary", [datafile, long_file], [f"{datafile}.hist.npz", f"{long_file}.npz"]):
+            if os.path.exists(long_file):
+                cache_long(long_file)
+            cache_histograms(datafile)
+    return int(params['RUNNR']), returncode
+
+def run_sweep(spec_path):
+    """Runs every card of a sweep specification on a pool of worker processes."""
+    spec = load_sweep_spec(spec_path)
+    runs = expand_sweep(spec)
+    corsika_dir = os.getcwd()
+    binary = os.path.abspath(spec.get('binary', CORSIKA_BINARY))
+    scratch_root = os.path.abspath(spec.get('scratch', 'sweep_scratch'))
+    epos_dir = os.path.abspath(spec.get('epos', '../epos')) + '/'
+    workers = int(spec.get('workers', os.cpu_count() or 1))
+
+    print(f"\nRunning {len(runs)} CORSIKA runs on {workers} workers...")
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_card, params, binary, scratch_root, corsika_dir, epos_dir) for params in runs]
+        for future in concurrent.futures.as_completed(futures):
+            runnr, returncode = future.result()
+            if returncode:
+                failed.append(runnr)
+                print(f"  Run {runnr:06d} failed (status {returncode}), see data_run_{runnr:06d}/corsika.log")
+            else:
+                print(f"  Run {runnr:06d} finished")
+                update_catalog(f"data_run_{runnr:06d}")
+    if os.path.isdir(scratch_root) and not os.listdir(scratch_root):
+        os.rmdir(scratch_root)
+    return failed
+
+MAX_SEED = 900000000
+LONG_SHOWER_PATTERN = re.compile(r'FOR SHOWER(\s+\d+)')
+
+def shard_cards(params: dict, shards: int) -> list:
+    """Splits a card into shards, each with its share of NSHOW, its own seeds and a sub-run number.
+
+    Shard 0 keeps the card's SEED sequences and RUNNR, so one shard is the
+    unsharded run. Shard i shifts both seeds by i times their spacing plus one,
+    which keeps every seed of every shard distinct.
+    """
+    values = {name: default for name, _, default in CARD_FIELDS}
+    values.update(params)
+    showers = int(values['NSHOW'])
+    shards = max(1, min(shards, showers))
+    seed1, seed2 = ([int(x) for x in str(values[name]).split()] for name in ['SEED1', 'SEED2'])
+    step = abs(seed2[0] - seed1[0]) + 1
+    if max(seed1[0], seed2[0]) + (shards - 1) * step > MAX_SEED:
+        print(f"Error: Seeds of {shards} shards would exceed {MAX_SEED}")
+        sys.exit(1)
+
+    cards = []
+    for shard in range(shards):
+        card = dict(values)
+        card['NSHOW'] = showers // shards + (shard < showers % shards)
+        card['RUNNR'] = (int(values['RUNNR']) + shard - 1) % 999999 + 1
+        card['SEED1'] = '   '.join(map(str, [seed1[0] + shard * step] + seed1[1:]))
+        card['SEED2'] = '   '.join(map(str, [seed2[0] + shard * step] + seed2[1:]))
+        cards.append(card)
+    return cards
+
+def write_particle_blocks(outfile, blocks):
+    """Writes whole records of sub-blocks to a particle file, returning the sub-blocks left over."""
+    count = len(blocks) // BLOCKS_PER_RECORD
+    records = np.empty(count, dtype=PARTICLE_RECORD_DTYPE)
+    records['head'] = records['tail'] = PARTICLE_RECORD_DTYPE.itemsize - 8
+    records['blocks'] = blocks[:count * BLOCKS_PER_RECORD].reshape(count, BLOCKS_PER_RECORD, BLOCK_WORDS)
+    outfile.write(records.tobytes())
+    return blocks[count * BLOCKS_PER_RECORD:]
+
+def merge_particle_files(files: list, output: str, runnr: int, chunk_records=4096) -> int:
+    """Merges the particle files of shards into one run, returning its number of showers.
+
+    The run header of the first file and the run end of the last one frame the
+    showers of all files, whose event numbers continue from one file to the next.
+    Run numbers are set to runnr.
+    """
+    events = 0
+    left = None
+    with open(output, 'wb') as outfile:
+        for datafile in files:
+            records = map_particles(datafile)
+            run_end = None
+            for start in range(0, len(records), chunk_records):
+                blocks = np.array(records['blocks'][start:start + chunk_records]).reshape(-1, BLOCK_WORDS)
+                kinds = block_kinds(records, start, start + chunk_records).reshape(-1)
+                if left is None:
+                    if kinds[0] != b'RUNH':
+                        print(f"Error: {datafile} does not start with a run header")
+                        sys.exit(1)
+                    left = blocks[:1].copy()
+                    left[0, 1] = runnr
+                end = np.flatnonzero(kinds == b'RUNE')
+                if len(end):
+                    run_end = blocks[end[0]].copy()
+                    blocks, kinds = blocks[:end[0]], kinds[:end[0]]
+                keep = kinds != b'RUNH'
+                blocks, kinds = blocks[keep], kinds[keep]
+                # Word 2 holds the event number, word 44 of the event header the run number
+                blocks[np.isin(kinds, [b'EVTH', b'EVTE', b'LONG']), 1] += events
+                blocks[kinds == b'EVTH', 43] = runnr
+                events += np.count_nonzero(kinds == b'EVTE')
+                left = write_particle_blocks(outfile, np.concatenate([left, blocks]))
+                if run_end is not None:
+                    break
+            if run_end is None:
+                print(f"Error: {datafile} has no run end, the shard did not finish")
+                sys.exit(1)
+        run_end[1], run_end[2] = runnr, events
+        blocks = np.concatenate([left, run_end[None]])
+        # The last record is padded with empty sub-blocks
+        padding = -len(blocks) % BLOCKS_PER_RECORD
+        write_particle_blocks(outfile, np.concatenate([blocks, np.zeros((padding, BLOCK_WORDS), dtype='f4')]))
+    return events
+
+def merge_long_files(files: list, output: str) -> int:
+    """Concatenates the .long files of shards, numbering their showers consecutively."""
+    showers = 0
+    with open(output, 'w') as outfile:
+        for path in files:
+            with open(path, 'r') as file:
+                text = file.read()
+            numbers = LONG_SHOWER_PATTERN.findall(text)
+            offset = showers
+            outfile.write(LONG_SHOWER_PATTERN.sub(
+                lambda match: f"FOR SHOWER {int(match.group(1)) + offset:>{len(match.group(1)) - 1}}", text))
+            showers += len({int(number) for number in numbers})
+    return showers
+
+def run_shards(params: dict, shards: int, binary=CORSIKA_BINARY, scratch_root="shard_scratch", log_dir=".",
+               epos_dir=None, check=True) -> int:
+    """Runs a card as concurrent CORSIKA shards and merges their outputs as a single run.
+
+    The particle file, .long file and track files of the shards are merged
+    into DATnnnnnn, DATnnnnnn.long and DATnnnnnn.track_* in the working
+    directory, named after the card's RUNNR; the shard logs go to log_dir.
+    Returns the exit status of the first failed shard, or 0.
+    """
+    cards = shard_cards(params, shards)
+    corsika_dir = os.getcwd()
+    binary = os.path.abspath(binary)
+    scratch_root = os.path.abspath(scratch_root)
+    epos_dir = epos_dir or os.path.abspath('../epos') + '/'
+    scratches = [prepare_scratch(os.path.join(scratch_root, f"shard_{shard}"), corsika_dir, card, epos_dir)
+                 for shard, card in enumerate(cards)]
+
+    print(f"\nRunning {sum(card['NSHOW'] for card in cards)} showers as {len(cards)} CORSIKA shards...")
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(cards)) as pool:
+        futures = {pool.submit(run_simulation, os.path.join(scratch, "user_card"), os.path.join(scratch, "corsika.log"),
+                               binary, cwd=scratch, progress=False, check=False): shard
+                   for shard, scratch in enumerate(scratches)}
+        returncodes = [0] * len(cards)
+        for future in concurrent.futures.as_completed(futures):
+            shard = futures[future]
+            returncodes[shard] = future.result()
+            print(f"  Shard {shard + 1} of {len(cards)} ({cards[shard]['NSHOW']} showers) "
+                  f"{'failed' if returncodes[shard] else 'finished'} after {format_seconds(time.time() - start)}")
+    for shard, scratch in enumerate(scratches):
+        shutil.move(os.path.join(scratch, "corsika.log"), os.path.join(log_dir, f"corsika.shard_{shard}.log"))
+    failed = [code for code in returncodes if code]
+    if failed:
+        print(f"Error: {len(failed)} CORSIKA shard(s) failed, see {os.path.join(log_dir, 'corsika.shard_*.log')}")
+        if check:
+            sys.exit(1)
+        return failed[0]
+
+    run_number_str = f"{int(cards[0]['RUNNR']):06d}"
+    outputs = [os.path.join(scratch, f"DAT{card['RUNNR']:06d}") for scratch, card in zip(scratches, cards)]
+    if all(os.path.exists(output) for output in outputs):
+        events = merge_particle_files(outputs, f"DAT{run_number_str}", int(cards[0]['RUNNR']))
+        print(f"  Merged {events} showers into DAT{run_number_str}")
+    if all(os.path.exists(output + ".long") for output in outputs):
+        merge_long_files([output + ".long" for output in outputs], f"DAT{run_number_str}.long")
+    for suffix in ['.track_em', '.track_mu', '.track_hd']:
+        if all(os.path.exists(output + suffix) for output in outputs):
+            with open(f"DAT{run_number_str}{suffix}", 'wb') as outfile:
+                for output in outputs:
+                    with open(output + suffix, 'rb') as file:
+                        shutil.copyfileobj(file, outfile)
+    shutil.rmtree(scratch_root)
+    return 0
+
+CATALOG_FILE = "runs.sqlite"
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    directory TEXT PRIMARY KEY,
+    run INTEGER,
+    signature TEXT,
+    cataloged TEXT,
+    {fields},
+    model TEXT,
+    energy_min REAL, energy_max REAL,
+    theta_min REAL, theta_max REAL,
+    phi_min REAL, phi_max REAL,
+    showers INTEGER,
+    xmax_mean REAL, xmax_rms REAL,
+    gamma INTEGER, electrons INTEGER, muons INTEGER, hadrons INTEGER,
+    total_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    directory TEXT,
+    path TEXT,
+    bytes INTEGER,
+    PRIMARY KEY (directory, path)
+);
+CREATE INDEX IF NOT EXISTS runs_run ON runs (run);
+CREATE INDEX IF NOT EXISTS runs_primary ON runs (prmpar, energy_min, theta_min);
+""".format(fields=',\n    '.join(f"{name.lower()} NUMERIC" for name, _, _ in CARD_FIELDS))
+CATALOG_COLUMNS = ['run', 'prmpar', 'nshow', 'energy_min', 'energy_max', 'theta_min', 'theta_max', 'showers',
+                   'xmax_mean', 'muons', 'total_bytes', 'directory']
+
+def parse_card(path) -> dict:
+    """Reads the CARD_FIELDS values back from a card written by card_content()."""
+    tokens = {name: len(default.split()) for name, _, default in CARD_FIELDS}
+    params = {}
+    with open(path, 'r') as file:
+        for line in file:
+            words = line.split()
+            if not words:
+                continue
+            name = words[0]
+            # The two SEED lines hold SEED1 and SEED2
+            if name == 'SEED':
+                name = 'SEED2' if 'SEED1' in params else 'SEED1'
+            if name in tokens and name not in params:
+                params[name] = ' '.join(words[1:1 + tokens[name]])
+    return params
+
+def open_catalog(catalog=CATALOG_FILE):
+    """Opens (creating it if needed) the SQLite catalog of runs."""
+    connection = sqlite3.connect(catalog, timeout=60)
+    connection.executescript(CATALOG_SCHEMA)
+    return connection
+
+def run_summary(directory, run: int, compute=False) -> dict:
+    """Returns the Xmax and observation level statistics of a run, from the cached .long and histogram files.
+
+    The caches are written by the run itself; with compute, missing ones are
+    created from the .long and particle files here.
+    """
+    summary = {}
+    long_file = os.path.join(directory, f"DAT{run:06d}.long")
+    profiles = None
+    if os.path.exists(long_file) and (compute or os.path.exists(f"{long_file}.npz")):
+        profiles = cache_long(long_file)
+    if profiles is not None:
+        xmax = profiles['gh_params'][:, 2]
+        xmax = xmax[np.isfinite(xmax)]
+        summary['showers'] = len(profiles['gh_params'])
+        if len(xmax):
+            summary['xmax_mean'], summary['xmax_rms'] = float(xmax.mean()), float(xmax.std())
+    datafile = os.path.join(directory, f"DAT{run:06d}")
+    histograms = cache_histograms(datafile) if compute else f"{datafile}.hist.npz"
+    if histograms and os.path.exists(histograms):
+        with np.load(histograms) as arrays:
+            summary['showers'] = int(arrays['showers'])
+            for group in PARTICLE_GROUPS:
+                summary[group] = int(arrays[f"lateral_counts_{group}"].sum())
+    return summary
+
+def catalog_run(connection, directory, compute=False) -> bool:
+    """Adds or refreshes a data_run_* directory in the catalog, telling whether it changed."""
+    card = os.path.join(directory, "user_card")
+    if not os.path.exists(card):
+        return False
+    params = parse_card(card)
+    run = int(params.get('RUNNR', 0))
+    try:
+        summary = run_summary(directory, run, compute)
+    except (SystemExit, Exception) as error:
+        print(f"  Warning: Summary statistics of {directory} could not be computed ({error})")
+        summary = {}
+
+    # The signature covers the caches written above, so an unchanged run is skipped next time
+    artifacts = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            artifacts[os.path.relpath(path, directory)] = os.stat(path)
+    signature = hashlib.sha256(json.dumps(sorted((path, info.st_size, info.st_mtime_ns)
+                                                 for path, info in artifacts.items())).encode()).hexdigest()
+    row = connection.execute("SELECT signature FROM runs WHERE directory = ?", (directory,)).fetchone()
+    if row and row[0] == signature:
+        return False
+
+    ranges = {}
+    for name, column in [('ERANGE', 'energy'), ('THETAP', 'theta'), ('PHIP', 'phi')]:
+        try:
+            ranges[f"{column}_min"], ranges[f"{column}_max"] = [float(x) for x in params[name].split()[:2]]
+        except (KeyError, ValueError):
+            pass
+    with open(card, 'r') as file:
+        model = 'EPOS' if 'EPOPAR' in file.read() else None
+    values = dict({name.lower(): value for name, value in params.items()}, **ranges, **summary,
+                  directory=directory, run=run, signature=signature, model=model,
+                  cataloged=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  total_bytes=sum(info.st_size for info in artifacts.values()))
+    with connection:
+        connection.execute(f"INSERT OR REPLACE INTO runs ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+                           list(values.values()))
+        connection.execute("DELETE FROM artifacts WHERE directory = ?", (directory,))
+        connection.executemany("INSERT INTO artifacts VALUES (?, ?, ?)",
+                               [(directory, path, info.st_size) for path, info in sorted(artifacts.items())])
+    return True
+
+def update_catalog(pattern="data_run_*", catalog=CATALOG_FILE, compute=False) -> int:
+    """Catalogs the new or changed run directories matching pattern and forgets deleted ones.
+
+    With compute, summary caches missing from a run directory are created.
+    """
+    connection = open_catalog(catalog)
+    directories = sorted(os.path.relpath(path) for path in glob.glob(pattern) if os.path.isdir(path))
+    updated = 0
+    for directory in directories:
+        try:
+            updated += catalog_run(connection, directory, compute)
+        except Exception as error:
+            print(f"  Warning: {directory} could not be cataloged ({error})")
+    known = [row[0] for row in connection.execute("SELECT directory FROM runs")]
+    with connection:
+        for directory in known:
+            if not os.path.isdir(directory):
+                connection.execute("DELETE FROM runs WHERE directory = ?", (directory,))
+                connection.execute("DELETE FROM artifacts WHERE directory = ?", (directory,))
+    connection.close()
+    print(f"  Catalog {catalog}: {updated} of {len(directories)} run(s) added or updated")
+    return updated
+
+def query_catalog(where="1", catalog=CATALOG_FILE, columns=CATALOG_COLUMNS) -> list:
+    """Prints and returns the cataloged runs matching an SQL condition on the runs table."""
+    if not os.path.exists(catalog):
+        print(f"Error: Catalog {catalog} not found, create it with --catalog")
+        sys.exit(1)
+    connection = open_catalog(catalog)
+    try:
+        rows = connection.execute(f"SELECT {', '.join(columns)} FROM runs WHERE {where} ORDER BY run").fetchall()
+    except sqlite3.Error as error:
+        print(f"Error: Invalid catalog query '{where}': {error}")
+        sys.exit(1)
+    finally:
+        connection.close()
+    print(' '.join(f"{column:>12}" for column in columns))
+    for row in rows:
+        print(' '.join(f"{value:>12.4g}" if isinstance(value, float) else f"{str(value):>12}" for value in row))
+    print(f"\n{len(rows)} run(s)")
+    return rows
+
 def main():
+    parser = argparse.ArgumentParser(description="Workflow for atmospheric shower simulations.")
+    parser.add_argument('--sweep', metavar='SPEC',
+                        help="run a parameter sweep from a JSON/YAML specification instead of the interactive workflow")
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f"directory holding the outputs of completed stages [DEFAULT: {CACHE_DIR}]")
+    parser.add_argument('--cache-limit', type=float, default=CACHE_LIMIT_MB, metavar='MB',
+                        help=f"size above which the least recently used cached stages are removed [DEFAULT: {CACHE_LIMIT_MB}]")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="run every stage from scratch without reading or filling the stage cache")
+    parser.add_argument('--native-plots', action='store_true',
+                        help="draw the track images with the built-in rasterizer instead of ./plottracks")
+    parser.add_argument('--render-workers', type=int, default=max(1, (os.cpu_count() or 1) // 8),
+                        help="number of Blender processes rendering frame ranges in parallel")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="split the showers of the run into this many CORSIKA processes and merge their outputs")
+    parser.add_argument('--stream-tracks', nargs='?', const='pipe', choices=['pipe', 'follow'],
+                        help="decode the track files while CORSIKA writes them, through named pipes (default) "
+                             "or by following the growing files")
+    parser.add_argument('--cpu-slots', type=int, default=os.cpu_count() or 1,
+                        help="number of CPUs shared by the stages running at the same time")
+    parser.add_argument('--memory-slots', type=int, default=total_memory_mb(), metavar='MB',
+                        help="memory in MB shared by the stages running at the same time")
+    parser.add_argument('--frames', type=int,
+                        help="number of animation frames, the shower time being remapped onto them "
+                             "[DEFAULT: one frame per microsecond]")
+    parser.add_argument('--duration', type=float, metavar='SECONDS',
+                        help="animation length, giving the number of frames together with --fps")
+    parser.add_argument('--fps', type=int, default=30, help="frame rate of the animation [DEFAULT: 30]")
+    parser.add_argument('--time-mapping', choices=TIME_MAPPINGS, default='linear',
+                        help="how shower times are spread over --frames or --duration [DEFAULT: linear]")
+    parser.add_argument('--late-tracks', choices=LATE_TRACKS, default='clip',
+                        help="whether the latest 1%% of times are clipped to the last frame or folded into "
+                             "the last tenth of the frames [DEFAULT: clip]")
+    parser.add_argument('--per-track-objects', action='store_true',
+                        help="build the Blender scene with one curve object per track instead of batched objects")
+    parser.add_argument('--index-tracks', action='store_true',
+                        help="build a spatio-temporal index of the decoded tracks for query_tracks()")
+    parser.add_argument('--histograms', metavar='DATFILE',
+                        help="write lateral-density and energy histograms of a DATnnnnnn particle file and exit")
+    parser.add_argument('--long-profiles', nargs='?', const="data_run_*/DAT*.long", metavar='PATTERN',
+                        help="aggregate the longitudinal profiles of the .long files matching PATTERN and exit")
+    parser.add_argument('--catalog', nargs='?', const="data_run_*", metavar='PATTERN',
+                        help=f"add new or changed run directories matching PATTERN to {CATALOG_FILE} and exit")
+    parser.add_argument('--query', metavar='CONDITION',
+                        help=f"list the runs of {CATALOG_FILE} matching an SQL condition and exit "
+                             "(ex: \"prmpar = 5626 AND theta_min = 30 AND energy_min > 1e7\")")
+    parser.add_argument('--report-summary', nargs='?', const=f"data_run_*/{REPORT_FILE}", metavar='PATTERN',
+                        help="print per-stage timing statistics over the run reports matching PATTERN and exit")
+    args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    if args.catalog or args.query:
+        if args.catalog:
+            update_catalog(args.catalog, compute=True)
+        if args.query:
+            query_catalog(args.query)
+        return
+
+    if args.report_summary:
+        summarize_reports(args.report_summary)
+        return
+
+    if args.histograms:
+        save_particle_histograms(args.histograms)
+        return
+
+    if args.long_profiles:
+        save_long_summary(args.long_profiles)
+        return
+
+    if args.stream_tracks and args.shards > 1:
+        print("Error: --stream-tracks cannot be combined with --shards")
+        sys.exit(1)
+    # The remapped shower time needs a first and a last frame
+    frames = args.frames
+    if frames is None and args.duration is not None:
+        frames = round(args.duration * args.fps)
+    if frames is not None and frames < 2:
+        print("Error: The animation needs at least 2 frames (--frames, or --duration times --fps)")
+        sys.exit(1)
+
+    if args.sweep:
+        failed = run_sweep(args.sweep)
+        if failed:
+            print(f"\n{len(failed)} run(s) failed: {', '.join(f'{runnr:06d}' for runnr in sorted(failed))}")
+            sys.exit(1)
+        print("\nAll sweep runs completed successfully!")
+        return
+
     print("Welcome to the workflow for atmospheric shower simulations!")
     
-    generate_input_file()
+    params = generate_input_file()
     
     runnr = 1
     with open("user_card", "r") as f:
@@ -483,44 +2470,145 @@ def main():
                 break
     
     run_number_str = f"{runnr:06d}"
-    
-    execute_command("./corsika78010Linux_EPOS_urqmd < user_card")
-    
-    plot_files = []
-    if os.path.exists("./plottracks"):
-        plot_files = plottracks(runnr)
-    else:
-        print("\nWarning: plottracks executable not found. Skipping image generation.")
-    
-    generate_animation = input("\nDo you want to generate the animation? (y/n) [DEFAULT: y]: ").lower() or "y"
-    
     execute_command(f"mkdir -p data_run_{run_number_str}")
+    report = new_report(os.path.join(f"data_run_{run_number_str}", REPORT_FILE), run=runnr)
     
+    # Every question is asked first, the stages then run unattended
+    native = args.native_plots or not os.path.exists("./plottracks")
+    if not args.native_plots and native:
+        print("\nWarning: plottracks executable not found. Using the built-in track rasterizer.")
+    if args.stream_tracks == 'pipe' and not native:
+        print("\nWarning: Streamed track files are not kept for plottracks. Using the built-in track rasterizer.")
+        native = True
+    plot_options = ask_plottracks(native)
+    generate_animation = input("\nDo you want to generate the animation? (y/n) [DEFAULT: y]: ").lower() or "y"
     if generate_animation == 'y':
-        # Processing data
-        print("\nProcessing data...")
-        tracks2root(runnr)
-        execute_command("python3 tracks2root.py")
-        process_files(['results_em', 'results_mu', 'results_hd'])
-        execute_command("rm results_*")
-        execute_command("head -n 5000 EDresults_em > EDresults_em_5k")
-        execute_command("mkdir data")
-        execute_command("mv EDresults* data/")
-        # Generate Blender animation
-        print("\nGenerating animation (it may take a while)...")
-        blender_visu_script()
-        execute_command("blender -b -P blender_script.py -E CYCLES -o img###.png -a")
-        execute_command("cat *.png | ffmpeg -f image2pipe -r 30 -i - output.mp4 -y")
-        execute_command("rm *.png output.blend")
-        execute_command(f"mv DAT* track* user_card data/ output.mp4 blender_script.py data_run_{run_number_str}/")
+        budgets, strategy, energy_cuts = ask_decimation()
+        blender_visu_script(not args.per_track_objects, frames, args.fps, args.time_mapping, args.late_tracks)
     else:
-        execute_command(f"mv DAT* track* user_card data_run_{run_number_str}/")
         print("\nSkipping animation generation.")
+
+    if args.shards > 1:
+        simulate = functools.partial(run_shards, params, args.shards, log_dir=f"data_run_{run_number_str}")
+    else:
+        simulate = functools.partial(run_simulation, log_file=os.path.join(f"data_run_{run_number_str}", "corsika.log"))
+    simulation_params = {}
+    if args.shards > 1:
+        simulation_params['shards'] = args.shards
+    simulation_outputs = [f"DAT{run_number_str}*"]
+    if args.stream_tracks:
+        # The tracks are decoded by the simulation stage itself
+        simulate = functools.partial(stream_tracks, runnr, simulate, follow=args.stream_tracks == 'follow')
+        simulation_params['stream'] = args.stream_tracks
+        if generate_animation == 'y':
+            # Cuts and streamable budgets are applied by the decoder, the decimation stage then keeps everything
+            simulate = functools.partial(simulate, budgets=budgets, strategy=strategy, energy_cuts=energy_cuts)
+            simulation_params['stream_selection'] = [budgets, strategy, energy_cuts]
+        simulation_outputs.append("EDresults_*.npy")
+    simulation = stage_key("simulation", simulation_params or None, inputs=["user_card"], binaries=[CORSIKA_BINARY])
+    nodes = {'simulation': {
+        'action': functools.partial(
+            run_stage, "simulation", simulation, simulation_outputs, simulate, cache_dir, report, ["user_card"]),
+        'cpus': args.shards, 'memory_mb': 1024 * args.shards
+    }}
+    datafile = f"DAT{run_number_str}"
+    nodes['histograms'] = {
+        'action': functools.partial(
+            run_stage, "histograms", stage_key("histograms", upstream=[simulation]), [f"{datafile}.hist.npz"],
+            functools.partial(cache_histograms, datafile), cache_dir, report, [datafile]),
+        'after': ['simulation'], 'memory_mb': 256
+    }
+    if plot_options:
+        nodes['plottracks'] = {
+            'action': functools.partial(draw_tracks, runnr, plot_options, native, report), 'after': ['simulation'],
+            'memory_mb': 256
+        }
+
+    if generate_animation == 'y':
+        # The em, mu and hd tracks are decoded, decimated and chained independently
+        chained = []
+        for particle, budget, energy_cut in zip(['em', 'mu', 'hd'], budgets, energy_cuts):
+            decoded = stage_key("decode", {'runnr': runnr, 'class': particle}, upstream=[simulation])
+            decoder = 'simulation' if args.stream_tracks else f'decode_{particle}'
+            if not args.stream_tracks:
+                nodes[decoder] = {
+                    'action': functools.partial(
+                        run_stage, decoder, decoded, [f"EDresults_{particle}.npy"],
+                        functools.partial(decode_tracks, runnr, classes=[particle]),
+                        cache_dir, report, [f"DAT{run_number_str}.track_{particle}"]),
+                    'after': ['simulation'], 'memory_mb': 128
+                }
+            if args.index_tracks:
+                nodes[f'index_{particle}'] = {
+                    'action': functools.partial(
+                        run_stage, f"index_{particle}", stage_key("index", upstream=[decoded]),
+                        [f"EDindex_{particle}.npy", f"EDindex_{particle}.npz"],
+                        functools.partial(index_tracks, f"EDresults_{particle}.npy"),
+                        cache_dir, report, [f"EDresults_{particle}.npy"]),
+                    'after': [decoder], 'memory_mb': 256
+                }
+            decimated = stage_key("filter", [budget, strategy, energy_cut], upstream=[decoded])
+            nodes[f'filter_{particle}'] = {
+                'action': functools.partial(
+                    run_stage, f"filter_{particle}", decimated, [f"EDsample_{particle}.npy"],
+                    functools.partial(decimate_files, [f"EDresults_{particle}.npy"], [budget], strategy, [energy_cut]),
+                    cache_dir, report, [f"EDresults_{particle}.npy"]),
+                'after': [decoder], 'memory_mb': stage_memory_mb([f"EDresults_{particle}.npy"], 1)
+            }
+            chained.append(stage_key("chaining", upstream=[decimated]))
+            nodes[f'chaining_{particle}'] = {
+                'action': functools.partial(
+                    run_stage, f"chaining_{particle}", chained[-1],
+                    [f"polylines_{particle}.npz"], functools.partial(chain_files, [f"EDsample_{particle}.npy"]),
+                    cache_dir, report, [f"EDsample_{particle}.npy"]),
+                'after': [f'filter_{particle}'], 'memory_mb': stage_memory_mb([f"EDsample_{particle}.npy"], 8)
+            }
+        chains = [f'chaining_{particle}' for particle in ['em', 'mu', 'hd']]
+        nodes['collect'] = {'action': functools.partial(collect_outputs, ["polylines_*"], "data"), 'after': chains}
+        # Generate Blender animation, next to the 2D images
+        render_cpus = max(1, args.cpu_slots - 1)
+        nodes['render'] = {
+            'action': functools.partial(
+                run_stage, "render",
+                stage_key("render", inputs=["blender_script.py"], binaries=[shutil.which("blender"), shutil.which("ffmpeg")],
+                          upstream=chained),
+                ["output.mp4"], functools.partial(render_animation, workers=args.render_workers, fps=args.fps, cpus=render_cpus),
+                cache_dir, report, ["data/polylines_*.npz"]),
+            # Blender takes every CPU but one, left to the single-threaded 2D images
+            'after': ['collect'], 'cpus': render_cpus, 'memory_mb': stage_memory_mb(["data/polylines_*.npz"], 20, 2048)
+        }
+
+    print("\nRunning the workflow stages...")
+    status = run_graph(nodes, args.cpu_slots, args.memory_slots)
+    if cache_dir:
+        prune_cache(cache_dir, args.cache_limit)
+
+    if generate_animation == 'y':
+        execute_command("rm -f img*.png output.blend frame_range.json")
+    # A resumed run replaces the outputs an earlier attempt left in the run folder
+    collect_outputs(["ED*", "polylines_*"], "data")
+    collect_outputs(["DAT*", "track*", "user_card", "data", "output.mp4", "blender_script.py", "ffmpeg.log"],
+                    f"data_run_{run_number_str}")
     
+    # Parse the longitudinal profiles once, later analyses read the cached arrays
+    long_file = os.path.join(f"data_run_{run_number_str}", f"DAT{run_number_str}.long")
+    if os.path.exists(long_file):
+        cache_long(long_file)
+    
+    failed = [name for name, state in status.items() if state != 'ok']
+    if failed:
+        print(f"\nError: Stages not completed: {', '.join(f'{name} ({status[name]})' for name in failed)}")
+        print(f"Completed outputs were moved to: data_run_{run_number_str}")
+        sys.exit(1)
+
+    # Record the run, with its summary statistics, in the catalog
+    update_catalog(f"data_run_{run_number_str}")
+
     # Final message
     print("\n" + "="*60)
     print("Process completed successfully!".center(60))
     print(f"\nAll generated files were moved to: data_run_{run_number_str}".center(60))
     print("="*60)
 
-main()
+if __name__ == "__main__":
+    main()